@@ -0,0 +1,213 @@
+'''
+Headless benchmark of the Workbench generators.
+Times stages of tree & bottle generation separately and writes JSON results to compare between commits:
+python3 P3dBenchmark.py --seeds 1 2 3 --grow-steps 10 --trees 20 -o results.json
+'''
+
+# python imports
+from typing import Iterable, Optional, List, Dict
+from contextlib import contextmanager
+from os import path
+from glob import glob
+import tempfile
+from sys import path as search_paths
+import argparse
+import json
+import platform
+import random
+import time
+
+# Panda3D imports
+from panda3d.core import load_prc_file_data, PandaSystem, NodePath, Vec2, Vec3, TransparencyAttrib, Texture, Filename
+
+# other imports
+import numpy as np
+
+# Workbench imports
+module_path = path.dirname(path.abspath(__file__))
+for search_path in ('../lib', '../tree', '../bottle'):
+	search_paths.insert(0, path.abspath(path.join(module_path, search_path)))
+TREE_PATH = path.abspath(path.join(module_path, '../tree'))
+BOTTLE_TEXTURES_PATH = path.abspath(path.join(module_path, '../bottle/textures'))
+
+
+class Stages:
+	'''
+	Wall time of benchmark stages: every stage may be measured many times
+	'''
+
+	def __init__(self):
+		self.times: Dict[str, List[float]] = {}
+
+	@contextmanager
+	def measure(self, name: str):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.times.setdefault(name, []).append(time.perf_counter() - start)
+
+	def get_results(self) -> Dict[str, Dict[str, float]]:
+		'returns count, total, mean & min time of every stage, seconds'
+		return {name: {'count': len(times), 'total': sum(times), 'mean': sum(times) / len(times), 'min': min(times)}
+			for name, times in self.times.items()}
+
+
+def bench_trees(stages: Stages, seeds: Iterable[int], grow_steps: int, batch: bool, use_store: bool,
+		single_geom: bool, instanced_leaves: bool, deferred_meshing = False, leaves_scale = .125) -> None:
+	'times skeleton growth, branches meshing, leaves placement & flattening of every tree'
+	from FractalBase import FractalBase
+	from P3dTree import DefaultTree
+	for seed in seeds:
+		with stages.measure('tree.init'):
+			t = DefaultTree(use_store, batch, seed, single_geom=single_geom, instanced_leaves=instanced_leaves,
+				deferred_meshing=deferred_meshing)
+		if deferred_meshing:
+			with stages.measure('tree.grow'):
+				for step in range(grow_steps):
+					t.grow(step == grow_steps - 1, leaves_scale)
+			with stages.measure('tree.finalize'):
+				t.finalize()
+			with stages.measure('tree.get_static'):
+				t.get_static()
+			continue
+		for step in range(grow_steps):
+			# the same steps as FractalTree.grow()
+			t.set_scale(t, 1.125)
+			with stages.measure('tree.grow'):
+				grown = FractalBase.grow(t)
+			with stages.measure('tree.draw_branch'):
+				t.draw_branches(grown)
+			with stages.measure('tree.leaves'):
+				t.track_leaves(t.added_ends, t.retired_ends)
+				if step == grow_steps - 1:
+					t.refresh_leaves(leaves_scale)
+		with stages.measure('tree.get_static'):
+			t.get_static()
+
+
+def bench_forest(stages: Stages, seeds: Iterable[int], grow_steps: int, max_workers: Optional[int],
+		lod: bool, instanced_leaves: bool, terrain_size = Vec3(512, 512, 10)) -> None:
+	'times forest generation at the process pool & placement of the trees at the terrain'
+	from P3dTree import FractalTree
+	from Forest import ForestBuilder
+	from Heightfield import Heightfield, TerrainNoise
+	with stages.measure('forest.terrain'):
+		heightfield = Heightfield.generate(int(terrain_size.x), int(terrain_size.y), TerrainNoise(seed=25), Vec2(0, 0), terrain_size,
+			cache_path=None)
+	forest_np, place_random = NodePath('Forest'), random.Random(0)
+	builder = ForestBuilder(grow_steps=grow_steps, max_workers=max_workers,
+		lod_levels=FractalTree.LOD_LEVELS if lod else None, instanced_leaves=instanced_leaves)
+	try:
+		with stages.measure('forest.build'):
+			trees = list(builder.build(seeds))
+		with stages.measure('forest.placement'):
+			place_rng = np.random.default_rng(0)
+			x, y = place_rng.uniform(0, terrain_size.x - 1, len(trees)), place_rng.uniform(0, terrain_size.y - 1, len(trees))
+			for t, pos in zip(trees, zip(x.tolist(), y.tolist(), heightfield.get_heights(x, y).tolist())):
+				t.set_pos(*pos)
+				t.set_scale(place_random.uniform(.25, 1))
+				t.reparent_to(forest_np)
+	finally:
+		builder.shutdown()
+
+
+def bench_bottles(stages: Stages, count: int) -> None:
+	'''times bottle creation with tessellation & with the shared geometry, flattening,
+	and instanced shelf of the same count of bottles with mixed labels;
+	the bottle is drawn by P3dBottleBase.__init__, so the construction is timed as the draw stage
+	'''
+	from TextureProps import TextureProps
+	from P3dBottle import P3dBottleBase, BottleShelf
+	labels = [TextureProps(path.join(BOTTLE_TEXTURES_PATH, name), anisotropic_degree=8, scale=(1, 3.3), transparency=TransparencyAttrib.MAlpha)
+		for name in ('vodka.stolichnaya.png', 'vodka.limonnaya.png', 'vodka.zubrovka.png', 'vodka.pertsovka.png')]
+	for _ in range(count):
+		P3dBottleBase.clear_geometry_cache()
+		with stages.measure('bottle.draw'):
+			bottle = P3dBottleBase(.28, .074, .02, .0345, .015, labels[0])
+		with stages.measure('bottle.get_static'):
+			bottle.get_static()
+		with stages.measure('bottle.draw_cached'):
+			P3dBottleBase(.28, .074, .02, .0345, .015, labels[0])
+	with stages.measure('shelf.init'):
+		shelf = BottleShelf(.28, .074, .02, .0345, .015, labels)
+	with stages.measure('shelf.set_bottles'):
+		pos = np.zeros((count, 3), np.float32)
+		pos[:, 0] = np.arange(count) * .08
+		shelf.set_bottles(BottleShelf.get_matrices(pos), np.arange(count) % len(labels))
+
+
+def bench_textures(stages: Stages, compression: str) -> None:
+	'times loads of the source images with mipmaps generation, textures baking & loads of the baked textures'
+	from TextureBake import TextureBake
+	texture_paths = sorted(glob(path.join(BOTTLE_TEXTURES_PATH, '*.png'))) \
+		+ [path.join(TREE_PATH, 'models/barkTexture.jpg'), path.join(TREE_PATH, 'terrain/texture.grass.jpg')]
+	with tempfile.TemporaryDirectory() as cache_path:
+		bake = TextureBake(cache_path, Texture.string_compression_mode(compression))
+		for texture_path in texture_paths:
+			with stages.measure('texture.source'):
+				texture = Texture()
+				texture.read(Filename.from_os_specific(texture_path))
+				texture.generate_ram_mipmap_images()
+			with stages.measure('texture.bake'):
+				bake.get(texture_path)
+			with stages.measure('texture.baked'):
+				Texture().read(Filename(bake.get(texture_path)))
+
+
+def main(args: Optional[List[str]] = None) -> dict:
+	parser = argparse.ArgumentParser(description='Headless benchmark of the Workbench generators')
+	parser.add_argument('--seeds', type=int, nargs='+', default=[1, 2, 3], help='trees seeds')
+	parser.add_argument('--grow-steps', type=int, default=10)
+	parser.add_argument('--trees', type=int, default=20, help='forest trees count; 0 - skip forest')
+	parser.add_argument('--bottles', type=int, default=20, help='bottles count; 0 - skip bottles')
+	parser.add_argument('--textures', action='store_true', help='time source & baked textures loads')
+	parser.add_argument('--texture-compression', default='off', help='baked textures compression: off, dxt1, dxt5, ...')
+	parser.add_argument('--mode', choices=('nested', 'store', 'batch'), default='batch', help='branches storage & growth mode')
+	parser.add_argument('--single-geom', action='store_true', help='draw branches to one Geom')
+	parser.add_argument('--instanced-leaves', action='store_true')
+	parser.add_argument('--deferred-meshing', action='store_true', help='mesh trees once after growth')
+	parser.add_argument('--lod', action='store_true', help='make LOD forest trees')
+	parser.add_argument('--workers', type=int, default=None, help='forest process pool size')
+	parser.add_argument('--window-type', choices=('none', 'offscreen'), default='none')
+	parser.add_argument('--stats', action='store_true', help='enable generators instrumentation & add its values to results')
+	parser.add_argument('-o', '--output', help='JSON results file; default - stdout')
+	args = parser.parse_args(args)
+
+	load_prc_file_data('', f'window-type {args.window_type}\naudio-library-name null\nnotify-level-device fatal\nmodel-path {TREE_PATH}')
+	from direct.showbase.ShowBase import ShowBase
+	ShowBase()
+
+	if args.stats:
+		from Stats import Stats
+		Stats.enable()
+	stages = Stages()
+	bench_trees(stages, args.seeds, args.grow_steps, args.mode == 'batch', args.mode == 'store',
+		args.single_geom, args.instanced_leaves, args.deferred_meshing)
+	if args.trees:
+		seeds = random.Random(args.seeds[0]).sample(range(2 ** 32), args.trees)
+		bench_forest(stages, seeds, args.grow_steps, args.workers, args.lod, args.instanced_leaves)
+	if args.bottles:
+		bench_bottles(stages, args.bottles)
+	if args.textures:
+		bench_textures(stages, args.texture_compression)
+
+	ret = {
+		'panda3d': PandaSystem.get_version_string(),
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'params': vars(args),
+		'stages': stages.get_results(),
+	}
+	if args.stats:
+		ret['stats'] = Stats.get()
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(ret, f, indent='\t')
+	else:
+		print(json.dumps(ret, indent='\t'))
+	return ret
+
+
+if __name__ == "__main__":
+	main()
@@ -1,6 +1,6 @@
 
 # python imports
-from typing import Iterable, Iterator, Optional, List, Tuple, NamedTuple, Callable
+from typing import Iterable, Iterator, Optional, Sequence, List, Tuple, Dict, NamedTuple, Callable
 import math
 import random
 from os import path
@@ -8,21 +8,43 @@ from sys import path as search_paths
 
 # Panda3D imports
 from panda3d.core import (Mat4, Vec2, Vec3, Vec4, Point3, Quat, Geom, GeomNode, Texture, TextureStage, TransparencyAttrib,
-	GeomVertexWriter, GeomTristrips, GeomVertexRewriter, GeomVertexData, GeomVertexFormat,
-	CollisionNode, CollisionTube, TransformState, NodePath, PNMImage, ShaderTerrainMesh, Shader, AmbientLight,
+	GeomTristrips, GeomVertexData, GeomVertexFormat,
+	CollisionTube, TransformState, NodePath, ModelNode, Filename, PNMImage, ShaderTerrainMesh, Shader, AmbientLight,
 	TextNode, WindowProperties, PandaSystem, LineSegs)
 from direct.gui.OnscreenText import OnscreenText
 
+# other imports
+import numpy as np
+
 # Workbench imports
 module_path = path.dirname(path.abspath(__file__))
 search_paths.insert(0, path.abspath(path.join(module_path, '../lib')))
 from TextureProps import TextureProps
+from TextureLoader import TextureLoader
+from TextureBake import TextureBake
+from RingMesh import RingMesh
+from Stats import Stats
+from CollisionTubes import CollisionTubes
+from InstanceBuffer import InstanceBuffer
+
+
+class BottleGeometry(NamedTuple):
+	'tessellated bottle shape shared by the bottles of the same shape parameters'
+	geoms: Tuple[Geom, ...] # side pieces; not owned by any bottle, the bottles get copies sharing vertices & primitives
+	tubes: np.ndarray # collision tubes (n, 7) of all pieces
 
 
 class P3dBottleBase(NodePath):
 
+	GEOMETRY_CACHE: Dict[tuple, BottleGeometry] = {} # shape key: geometry
+
 	def __init__(self, bottle_len: float, neck_len: float, neck_narrow_len: float,
-			bottle_radius: float, neck_radius: float, tex: TextureProps, num_side_slices = 15):
+			bottle_radius: float, neck_radius: float, tex: TextureProps, num_side_slices = 15,
+			collision_min_radius: Optional[float] = 0, texture_loader: Optional[TextureLoader] = None):
+		'''
+		collision_min_radius -:- drawn pieces not thinner than it get collision tubes; None - no collision tubes
+		texture_loader -:- loads the label by background thread; None - blocking load
+		'''
 		super().__init__('Bottle Holder')
 
 		self.bottle_radius, self.neck_radius = bottle_radius, neck_radius
@@ -30,125 +52,215 @@ class P3dBottleBase(NodePath):
 		self.num_side_slices = num_side_slices
 
 		self.body_np = NodePath('Body')
-		self.collision_np = self.attach_new_node(CollisionNode('Collision'))
+		self.collision_np = self.attach_new_node(CollisionTubes.make_node(()))
+		self.collision_min_radius = collision_min_radius
 		self.bodydata = GeomVertexData('body vertices',
 									   GeomVertexFormat.getV3n3t2(),
 									   Geom.UHStatic)
-		self.collision_np.show()
 		self.collision_np.reparent_to(self)
 		self.body_np.reparent_to(self)
 
 		self.texture_props = tex
 		self.ts = TextureStage('ts')
-		self.texture = base.loader.loadTexture(self.texture_props.path)
-		self.body_np.set_texture(self.ts, self.texture)
-		self.texture_props.set_texture_props(self.texture, self.body_np, self.ts)
+		self.texture = self.texture_props.load(self.body_np, self.ts, texture_loader)
 		# self.body_np.set_tex_scale(self.ts, 1, 3.3)
 
-		self.position = Vec3(0, 0, 0) # сurrent point on the axis of symmetry
-		self.texture_v_coord = 0
-
 		self.draw()
 
+	def get_shape_key(self) -> tuple:
+		return (self.bottle_len, self.neck_len, self.neck_narrow_len, self.bottle_radius, self.neck_radius,
+			self.num_side_slices)
+
+	@classmethod
+	def get_geometry(cls, bottle_len: float, neck_len: float, neck_narrow_len: float,
+			bottle_radius: float, neck_radius: float, num_side_slices = 15) -> BottleGeometry:
+		'returns tessellated geometry of the bottle shape; the shape is tessellated once, the next calls return the cached geometry'
+		key = (bottle_len, neck_len, neck_narrow_len, bottle_radius, neck_radius, num_side_slices)
+		if (ret := cls.GEOMETRY_CACHE.get(key)) is None:
+			ret = cls.GEOMETRY_CACHE[key] = cls.tessellate((
+				(0, .0),
+				(bottle_radius, bottle_len - neck_len - neck_narrow_len),
+				(bottle_radius, neck_narrow_len),
+				(neck_radius, neck_len),
+				(neck_radius, 0),
+				(0, .0),
+			), num_side_slices)
+		elif Stats.enabled:
+			Stats.count('bottle geometry cache hits')
+		return ret
+
+	@classmethod
+	def clear_geometry_cache(cls) -> None:
+		cls.GEOMETRY_CACHE.clear()
+
+	@Stats.timed
 	def draw(self):
-		self.draw_piece(0, .0)
-		self.draw_piece(self.bottle_radius, self.bottle_len - self.neck_len - self.neck_narrow_len)
-		self.draw_piece(self.bottle_radius, self.neck_narrow_len)
-		self.draw_piece(self.neck_radius, self.neck_len)
-		self.draw_piece(self.neck_radius, 0)
-		self.draw_piece(0, .0)
-
+		'''draws the bottle pieces once per shape parameters (see get_geometry);
+		the bottles of the same shape share Geoms & vertices, the texture state is set to every bottle body_np
+		'''
+		geometry = self.get_geometry(*self.get_shape_key())
+		for geom in geometry.geoms:
+			circle_geom_node = GeomNode("Debug")
+			circle_geom_node.add_geom(geom.make_copy()) # vertices & primitives are shared, not copied
+			self.body_np.attach_new_node(circle_geom_node)
+		if Stats.enabled:
+			Stats.count('GeomNodes', len(geometry.geoms))
+		if geometry.geoms:
+			self.bodydata = geometry.geoms[0].get_vertex_data()
+		if self.collision_min_radius is not None:
+			CollisionTubes.add_solids(self.collision_np.node(),
+				geometry.tubes[geometry.tubes[:, 6] >= self.collision_min_radius])
+
+	@Stats.timed
 	def get_static(self) -> NodePath:
 		'makes a flattened version of the tree for faster rendering'
-		np = NodePath(self.node().copySubgraph())
-		np.flattenStrong()
-		return np
+		static_np = NodePath(self.node().copySubgraph())
+		static_np.flattenStrong()
+		return static_np
 
-	def make_collision(self, pos: Vec3, new_pos: Vec3, radius: float) -> None:
-		'''
-		make a collision tube for the given stem-parameters
-		'''
-		tube = CollisionTube(Point3(pos), Point3(new_pos), radius)
-		self.collision_np.node().addSolid(tube)
+	@staticmethod
+	def tessellate(pieces: Iterable[Tuple[float, float]], num_side_slices: int) -> BottleGeometry:
+		'''draws pieces of the bottle as cylinders along the axis of symmetry
+		This draws a ring of vertices per piece and connects the rings with triangles to from the bottle pieces.
+		The Geoms are not owned by any bottle: the bottles get copies sharing vertices & primitives.
 
-	def draw_piece(self, radius: float, len: float) -> None:
-		'''draws piece of the bottle as cylinder
-		This draws a ring of vertices and connects the rings with triangles to from the bottle piece.
+		pieces -:- radius & length of every piece
 		'''
+		vdata = GeomVertexData('body vertices', GeomVertexFormat.getV3n3t2(), Geom.UHStatic)
+		geoms, tubes = [], []
+		position = Vec3(0, 0, 0) # сurrent point on the axis of symmetry; texture V coord is the same as position.z
+		circle: Optional[Tuple[Vec3, float]] = None # center & radius of the last drawn circle
+		for radius, len in pieces:
+			# add circle # index of first vertex of current drawing piece
+			start_row = RingMesh.append_rows(vdata, RingMesh.make_rings(
+				(position, ), (Vec3.right(), ), (Vec3.forward(), ), (radius, ), (position.z, ), num_side_slices))
+
+			if circle is not None and circle[0] != position:
+				# cylinder from the previous circle
+				tubes.append((*circle[0], *position, max(circle[1], radius)))
+			circle = Vec3(position), radius
+
+			position.z += len
+
+			if start_row:
+				# Use Tristrips geom to draw cylinder side slices. One slice vertex order:
+				# 0 2 # second circle # vdata vertex indexes: 2, 3
+				# 1 3 # first circle  # vdata vertex indexes: 0, 1
+				lines = GeomTristrips(Geom.UHStatic)
+				# start_row - num_side_slices - 1: index of first vertex of previous circle
+				RingMesh.add_strips(lines, (start_row - num_side_slices - 1, ), num_side_slices)
+				circle_geom = Geom(vdata)
+				circle_geom.add_primitive(lines)
+				geoms.append(circle_geom)
+		return BottleGeometry(tuple(geoms), np.array(tubes, np.float32).reshape(-1, 7))
+
+
+class BottleShelf(NodePath):
+	'''
+	Bottles of one shape with different labels drawn by one instanced draw call: labels are packed
+	to 2D texture array, transforms & label layers of all bottles are packed to buffer texture (see InstanceBuffer) and applied by the shader.
+	Transforms are relative to the node; flattening does not touch the node.
+	'''
+
+	SHADER_PATHS = ('shelf/shelf.vert.glsl', 'shelf/shelf.frag.glsl')
 
-		# print(f'draw_piece: {radius=} {len=} {num_side_slices=}')
-		vdata = self.bodydata
-		circle_geom = Geom(vdata)
-		vert_writer = GeomVertexWriter(vdata, "vertex")
-		normal_writer = GeomVertexWriter(vdata, "normal")
-		tex_rewriter = GeomVertexRewriter(vdata, "texcoord")
-		start_row = vdata.get_num_rows() # index of first vertex of current drawing piece
-		vert_writer.set_row(start_row)
-		normal_writer.set_row(start_row)
-		tex_rewriter.set_row(start_row)
-		tex_v_coord = self.texture_v_coord # get total length to current piece
-		pos = self.position
-		num_side_slices = self.num_side_slices
-		slice_angle = 2 * math.pi / num_side_slices
-
-		# add circle
-		curr_angle, perp1, perp2 = 0, Vec3.right(), Vec3.forward()
-		# print(f'{pos=}')
-		# add cylinder side circle slice by slice
-		# face side vertex order is left to right ->
-		# Example for branch{pos=(0, 0, 0) radius=1} num_side_slices = 4:
-		# vertexes positions: (1, 0, 0), (0, 1, 0), (-1, 0, 0), (0, -1, 0)
-		# texture UV coords:  (0, 0),    (0.25, 0), (0.5, 0),   (0.75, 0)
-		for i in range(num_side_slices + 1): # doubles the last vertex to fix UV seam
-			# add vertex, normal & texture coord
-			normal = perp1 * math.cos(curr_angle) + perp2 * math.sin(curr_angle)
-			vert_pos = pos + normal * radius
-			# print(f'{i + start_row} {vert_pos}')
-			normal_writer.add_data3f(normal)
-			vert_writer.add_data3f(vert_pos)
-			tex_rewriter.add_data2f(i / num_side_slices, tex_v_coord)
-			curr_angle += slice_angle
-
-		self.texture_v_coord += len
-		self.position.z += len
-
-		if start_row:
-			# Use Tristrips geom to draw cylinder side slices. One slice vertex order:
-			# 0 2 # second circle # self.bodydata vertex indexes: 2, 3
-			# 1 3 # first circle  # self.bodydata vertex indexes: 0, 1
-			# Example self.bodydata vertex indexes for num_side_slices = 4:
-			# 4 5 6 7 # second circle
-			# 0 1 2 3 # first circle
-			lines = GeomTristrips(Geom.UHStatic)
-			# start_row: index of first vertex of first circle # doubles the last vertex to fix UV seam
-			for i in range(start_row - num_side_slices - 1, start_row + 1):
-				# print(f'add vertex: {i} {i + num_side_slices}')
-				lines.add_vertex(i + num_side_slices) # second circle
-				lines.add_vertex(i) # first circle
-			lines.close_primitive()
-			# lines.decompose()
-			circle_geom.add_primitive(lines)
-			circle_geom_node = GeomNode("Debug")
-			circle_geom_node.add_geom(circle_geom)
-			self.body_np.attach_new_node(circle_geom_node)
+	def __init__(self, bottle_len: float, neck_len: float, neck_narrow_len: float,
+			bottle_radius: float, neck_radius: float, labels: Sequence[TextureProps], num_side_slices = 15,
+			name = 'Bottle Shelf'):
+		'''
+		labels -:- labels textures of the bottles; scale, filters & transparency are taken from the first one
+		'''
+		super().__init__(ModelNode(name))
+		self.node().set_preserve_transform(ModelNode.PT_no_touch)
+		self.labels = tuple(labels)
+
+		# shared geometry of the shape as one Geom
+		body_node = GeomNode('Bottle')
+		for geom in P3dBottleBase.get_geometry(bottle_len, neck_len, neck_narrow_len, bottle_radius, neck_radius, num_side_slices).geoms:
+			body_node.add_geom(geom.make_copy())
+		body_node.unify(0xffff, False) # one Geom of one primitive
+		self.attach_new_node(body_node)
+		self.bottle_bounds = body_node.get_bounds()
+
+		self.labels_texture = self.load_labels(self.labels)
+		self.labels[0].set_texture_props(self.labels_texture, self)
+		self.transforms = Texture('bottle transforms')
+		self.matrices, self.layers = np.zeros((0, 4, 4), np.float32), np.zeros(0, np.float32)
+		self.set_shader(Shader.load(Shader.SL_GLSL, *(Filename.from_os_specific(path.join(module_path, p)) for p in self.SHADER_PATHS)))
+		self.set_shader_input('labels', self.labels_texture)
+		self.set_shader_input('label_scale', Vec2(*(self.labels[0].scale or (1, 1))))
+		self.set_shader_input('bottle_transforms', self.transforms)
+		self.set_bottles(self.matrices, self.layers)
+
+	def reload_labels(self) -> None:
+		'reloads the labels texture array in place, for example when a label file is changed'
+		TextureLoader.set_images(self.labels_texture, self.load_labels(self.labels))
+		self.labels[0].set_texture_props(self.labels_texture)
+
+	@staticmethod
+	def load_labels(labels: Sequence[TextureProps], name = 'bottle labels') -> Texture:
+		'returns 2D texture array of the labels images; the images are resized to the size of the first one'
+		images = [PNMImage(Filename.from_os_specific(label.path)) for label in labels]
+		x_size, y_size = images[0].get_x_size(), images[0].get_y_size()
+		ret = Texture(name)
+		ret.setup_2d_texture_array(x_size, y_size, len(images), Texture.T_unsigned_byte, Texture.F_rgba)
+		for layer, image in enumerate(images):
+			if (image.get_x_size(), image.get_y_size()) != (x_size, y_size) or image.get_num_channels() != 4:
+				resized = PNMImage(x_size, y_size, 4)
+				resized.fill(1)
+				resized.alpha_fill(1)
+				resized.quick_filter_from(image)
+				image = resized
+			ret.load(image, layer, 0)
+		return ret
+
+	@staticmethod
+	def get_matrices(pos: np.ndarray, h: Optional[np.ndarray] = None, scale = 1.) -> np.ndarray:
+		'''returns bottles matrices: Mat4.scale_mat(scale) * Mat4.rotate_mat(h, Vec3.up()) * Mat4.translate_mat(pos)
+		pos, h -:- (n, 3) positions & (n, ) headings of bottles, degrees
+		'''
+		pos = np.asarray(pos, np.float32).reshape(-1, 3)
+		h = np.radians(np.zeros(len(pos)) if h is None else np.asarray(h, np.float64))
+		c, s = (np.cos(h) * scale).astype(np.float32), (np.sin(h) * scale).astype(np.float32)
+		ret = np.zeros((len(pos), 4, 4), np.float32)
+		ret[:, 0, 0], ret[:, 0, 1], ret[:, 1, 0], ret[:, 1, 1] = c, s, -s, c
+		ret[:, 2, 2] = scale
+		ret[:, 3, :3] = pos
+		ret[:, 3, 3] = 1
+		return ret
+
+	def set_bottles(self, matrices: np.ndarray, layers: np.ndarray) -> None:
+		'''replaces bottles
+		matrices -:- (n, 4, 4) transforms of bottles
+		layers -:- (n, ) indexes of bottles labels
+		'''
+		self.matrices = np.ascontiguousarray(matrices, np.float32)
+		self.layers = np.asarray(layers, np.float32)
+		data = np.zeros((len(self.matrices), 1, 4), np.float32) # label layer at x of the texel following the matrix
+		data[:, 0, 0] = self.layers
+		InstanceBuffer.set_instances(self, self.transforms, self.matrices, self.bottle_bounds, data)
 
 
 if __name__ == "__main__":
 	from direct.showbase.ShowBase import ShowBase
 	from os import uname
 	from RadioButtons import RadioButtons
+	from AssetWatcher import AssetWatcher
 
 	MODULE_PATH = path.dirname(path.abspath(__file__))
 	TEXTURES_PATH = path.join(MODULE_PATH, 'textures/')
 
 	global demo_bottle, distance
 	base, demo_bottle, distance = ShowBase(), None, 0
+	texture_loader = TextureLoader(bake=TextureBake()) # labels are baked once & loaded while the scene is shown
+	asset_watcher = AssetWatcher() # changed labels & shaders files are reloaded while the demo runs
+	asset_watcher.watch_shader(base.render, *(Filename.from_os_specific(path.join(module_path, p)) for p in BottleShelf.SHADER_PATHS))
 
 	props = WindowProperties()
 	props.set_title(f'Panda3D Workbench - (P3D {PandaSystem.get_version_string()} on {uname().sysname} {uname().release} {uname().machine})')
 	base.win.request_properties(props)
 
-	def look_camera_at_entire_object(np: NodePath, camera=base.cam, lense=base.camLens):
+	def look_camera_at_entire_object(node_np: NodePath, camera=base.cam, lense=base.camLens):
 
 		def get_distance(radius) -> float:
 			if lense:
@@ -156,7 +268,7 @@ if __name__ == "__main__":
 				return radius / math.tan(math.radians(min(fov[0], fov[1]) / 2.))
 			return 50.
 
-		bounds = np.get_bounds()
+		bounds = node_np.get_bounds()
 		camera.set_pos(Vec3.forward() * (get_distance(bounds.get_radius()) + distance))
 		camera.look_at(bounds.get_center())
 
@@ -182,6 +294,11 @@ if __name__ == "__main__":
 		def place_bottle(cls, bottle: NodePath):
 			global demo_bottle
 			demo_bottle = bottle # save bottle NodePath
+			if isinstance(bottle, P3dBottleBase):
+				asset_watcher.watch_texture(bottle.texture, bottle.texture_props, texture_loader)
+			else:
+				for label in bottle.labels:
+					asset_watcher.watch(label.path, bottle.reload_labels, ('labels', label.path))
 			bottle.reparent_to(base.render)
 			look_camera_at_entire_object(bottle)
 			cls.draw_axes()
@@ -189,12 +306,12 @@ if __name__ == "__main__":
 		@classmethod
 		def type_iii_500(cls, tex_props: TextureProps):
 			'bottle type III, 500 ml, GOST 10117-91, draw 3, page 3'
-			cls.place_bottle(P3dBottleBase(.28, .074, .02, .0345, .015, tex_props))
+			cls.place_bottle(P3dBottleBase(.28, .074, .02, .0345, .015, tex_props, texture_loader=texture_loader))
 
 		@classmethod
 		def type_xa(cls, tex_props: TextureProps):
 			'bottle type Xa, 500 ml, GOST 10117-91, draw 9a, page 5'
-			cls.place_bottle(P3dBottleBase(.23, .02, .085, .036, .013, tex_props))
+			cls.place_bottle(P3dBottleBase(.23, .02, .085, .036, .013, tex_props, texture_loader=texture_loader))
 
 
 	class Vodka:
@@ -233,11 +350,25 @@ if __name__ == "__main__":
 				anisotropic_degree=8, scale=(1, 3.3), transparency=TransparencyAttrib.MAlpha))
 
 
+	class Shelf:
+
+		@classmethod
+		def Vodka(cls, rows = 20, columns = 20):
+			'bottles type III with mixed labels drawn by one instanced draw call'
+			labels = [TextureProps(TEXTURES_PATH+name, anisotropic_degree=8, scale=(1, 3.3), transparency=TransparencyAttrib.MAlpha)
+				for name in ('vodka.stolichnaya.png', 'vodka.limonnaya.png', 'vodka.zubrovka.png', 'vodka.pertsovka.png')]
+			shelf, rng = BottleShelf(.28, .074, .02, .0345, .015, labels), np.random.default_rng(0)
+			x, z = np.meshgrid(np.arange(columns) * .08, np.arange(rows) * .32)
+			pos = np.stack((x.ravel() - x.max() / 2, np.zeros(x.size), z.ravel()), axis=-1)
+			shelf.set_bottles(BottleShelf.get_matrices(pos, rng.uniform(0, 360, len(pos))), rng.integers(0, len(labels), len(pos)))
+			BottleGost.place_bottle(shelf)
+
+
 	class BigBottle:
 
 		def bottle(tex_props: TextureProps):
 			# draw bottle
-			BottleGost.place_bottle(P3dBottleBase(.51, .1, .05, .15, .025, tex_props))
+			BottleGost.place_bottle(P3dBottleBase(.51, .1, .05, .15, .025, tex_props, texture_loader=texture_loader))
 
 		@classmethod
 		def Alcohol(cls):
@@ -254,7 +385,7 @@ if __name__ == "__main__":
 		global demo_menu
 		demo_text = list((
 			OnscreenText(' Panda3D workbench: bottle ', scale=.05, pos=(0, .95), fg=(.75, .75, .55, .75), bg=(.5, .5, .5, .5), align=TextNode.ACenter),
-			OnscreenText('Press <Esc> to show menu, use arrows keys and <Enter> or mouse, <r> - reset view, <F5> - reload model', scale=.04, fg=(.75, .75, .55, .75), pos=(0, .9), align=TextNode.ACenter),
+			OnscreenText('Press <Esc> to show menu, use arrows keys and <Enter> or mouse, <r> - reset view, <F5> - reload textures', scale=.04, fg=(.75, .75, .55, .75), pos=(0, .9), align=TextNode.ACenter),
 		))
 		try:
 			selected_index = demo_selected_index
@@ -269,6 +400,7 @@ if __name__ == "__main__":
 			('Beer Zhiguli Chernihiv', Beer.Zhiguli_Chernihiv),
 			('Big Alcohol', BigBottle.Alcohol),
 			('Big Formalin', BigBottle.Formalin),
+			('Vodka Shelf', Shelf.Vodka),
 		), selected_index = selected_index)
 
 	def clear_scene():
@@ -333,13 +465,11 @@ if __name__ == "__main__":
 			look_camera_at_entire_object(demo_bottle)
 
 	def btn_reload():
-		if demo_bottle and demo_menu.selected_callback:
-			base.loader.unload_texture(demo_bottle.texture)
-			demo_bottle.texture = demo_bottle.ts = None
-			hpr = demo_bottle.get_hpr()
-			clear_scene()
-			demo_menu.selected_callback()
-			demo_bottle.set_hpr(hpr)
+		# textures are reloaded in place: geometry & camera are kept
+		if isinstance(demo_bottle, P3dBottleBase):
+			texture_loader.reload(demo_bottle.texture, demo_bottle.texture_props)
+		elif isinstance(demo_bottle, BottleShelf):
+			demo_bottle.reload_labels()
 
 
 	base.accept('escape', btn_escape)
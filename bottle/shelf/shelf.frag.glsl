@@ -0,0 +1,18 @@
+#version 330
+
+// Instanced bottles fragment shader: label of the bottle from the texture
+// array lit by ambient light and tinted by the node color scale.
+
+in vec3 texcoord;
+out vec4 color;
+
+uniform sampler2DArray labels;
+uniform vec4 p3d_ColorScale;
+uniform struct {
+  vec4 ambient;
+} p3d_LightModel;
+
+void main() {
+  vec4 diffuse = texture(labels, texcoord);
+  color = vec4(diffuse.rgb * p3d_LightModel.ambient.rgb, diffuse.a) * p3d_ColorScale;
+}
@@ -0,0 +1,25 @@
+#version 330
+
+// Instanced bottles vertex shader. Every instance takes its transform and
+// label from the buffer texture: 4 texels are the rows of Panda3D matrix,
+// x of the 5th texel is the layer of the labels texture array.
+
+in vec4 p3d_Vertex;
+in vec2 p3d_MultiTexCoord0;
+uniform mat4 p3d_ModelViewProjectionMatrix;
+uniform samplerBuffer bottle_transforms;
+uniform vec2 label_scale;
+
+out vec3 texcoord;
+
+void main() {
+  int row = gl_InstanceID * 5;
+  // matrix layout: see lib/InstanceBuffer.py
+  mat4 bottle_transform = mat4(
+    texelFetch(bottle_transforms, row),
+    texelFetch(bottle_transforms, row + 1),
+    texelFetch(bottle_transforms, row + 2),
+    texelFetch(bottle_transforms, row + 3));
+  gl_Position = p3d_ModelViewProjectionMatrix * (bottle_transform * p3d_Vertex);
+  texcoord = vec3(p3d_MultiTexCoord0 * label_scale, texelFetch(bottle_transforms, row + 4).x);
+}
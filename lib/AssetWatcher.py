@@ -0,0 +1,123 @@
+
+# python imports
+from typing import Optional, Callable, Dict, Tuple, Hashable
+import os
+
+# Panda3D imports
+from panda3d.core import NodePath, Texture, Shader, ShaderAttrib
+
+# Workbench imports
+from TextureLoader import TextureLoader
+
+
+class AssetWatcher:
+	'''
+	Hot reload of changed assets files: the files are polled by task manager task and only the changed assets are replaced,
+	the geometry, other assets & camera are kept. Textures are reloaded in place, so every node using the texture shows
+	the new image; changed shader is made again and set instead of the old one to the nodes of the root subgraph.
+	A file is reloaded when it is not changed for one poll interval: a file being written is not read.
+	'''
+
+	def __init__(self, interval = .5, name = 'Asset Watcher'):
+		'''
+		interval -:- files polling interval, seconds
+		'''
+		self.interval, self.name = interval, name
+		# file path: last seen & last loaded file signatures, callbacks by key
+		self.files: Dict[str, Tuple[list, Dict[Hashable, Callable[[], None]]]] = {}
+		self.task = None
+
+	@staticmethod
+	def get_signature(file_path: str) -> Optional[Tuple[int, int]]:
+		'returns modification time & size of the file; None if the file is absent'
+		try:
+			stat = os.stat(file_path)
+		except OSError:
+			return None
+		return stat.st_mtime_ns, stat.st_size
+
+	def watch(self, file_path: str, on_changed: Callable[[], None], key: Optional[Hashable] = None) -> None:
+		'''calls on_changed when the file is changed
+		key -:- callback of the file with the same key is replaced; None - the callback
+		'''
+		file_path = os.path.abspath(file_path)
+		if (entry := self.files.get(file_path)) is None:
+			signature = self.get_signature(file_path)
+			entry = self.files[file_path] = [signature, signature], {}
+		entry[1][on_changed if key is None else key] = on_changed
+		self.start()
+
+	def watch_texture(self, texture: Texture, props: 'TextureProps', loader: Optional[TextureLoader] = None) -> None:
+		'''reloads the texture in place when its image file is changed; the props are set again
+		loader -:- the texture is reloaded by background thread; None - blocking reload
+		'''
+
+		def on_changed():
+			if loader is not None:
+				loader.reload(texture, props)
+				return
+			source = Texture(texture.get_name())
+			if source.read(filename):
+				TextureLoader.set_images(texture, source)
+				props.set_texture_props(texture)
+
+		filename = TextureLoader.resolve(props.path)
+		self.watch(filename.to_os_specific(), on_changed, ('texture', texture.this))
+
+	def watch_shader(self, root: NodePath, vertex_path: str, fragment_path: str) -> None:
+		'''replaces the GLSL shader of the nodes of the root subgraph when the shader file is changed
+		vertex_path, fragment_path -:- the shader files as given to Shader.load(); relative path is found at model-path
+		'''
+		# the loaded shader & made by reloads: nodes made after reload by Shader.load() get the cached loaded shader
+		shaders = [Shader.load(Shader.SL_GLSL, vertex=vertex_path, fragment=fragment_path)]
+		paths = tuple(TextureLoader.resolve(p).to_os_specific() for p in (vertex_path, fragment_path))
+
+		def on_changed():
+			replaced = {shader.this for shader in shaders}
+			# Shader.load() returns the cached shader: the shader is made of the files text
+			texts = []
+			for file_path in paths:
+				with open(file_path) as f:
+					texts.append(f.read())
+			new_shader = Shader.make(Shader.SL_GLSL, *texts)
+			if new_shader is None:
+				return
+			for node_np in [root] + list(root.find_all_matches('**')):
+				attrib = node_np.node().get_attrib(ShaderAttrib)
+				if attrib is not None and attrib.get_shader() is not None and attrib.get_shader().this in replaced:
+					node_np.set_shader(new_shader, attrib.get_shader_priority())
+			shaders.append(new_shader)
+
+		for file_path in paths:
+			self.watch(file_path, on_changed, ('shader', root.this, paths))
+
+	def poll(self) -> None:
+		'calls callbacks of the changed files'
+		# callbacks may watch other files or clear
+		for file_path, (signatures, callbacks) in list(self.files.items()):
+			signature = self.get_signature(file_path)
+			if signature is not None and signature == signatures[0] and signature != signatures[1]:
+				signatures[1] = signature
+				for on_changed in list(callbacks.values()):
+					on_changed()
+			signatures[0] = signature
+
+	def start(self, task_mgr = None) -> None:
+		'''starts the task polling the files
+		task_mgr -:- None - base.taskMgr
+		'''
+		if self.task is None:
+			self.task = (task_mgr or base.taskMgr).do_method_later(self.interval, self.poll_task, self.name)
+
+	def stop(self) -> None:
+		if self.task is not None:
+			self.task.remove()
+			self.task = None
+
+	def clear(self) -> None:
+		'stops watching all files'
+		self.files.clear()
+
+	def poll_task(self, task):
+		self.poll()
+		return task.again
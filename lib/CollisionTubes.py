@@ -0,0 +1,58 @@
+
+# Panda3D imports
+from panda3d.core import Point3, Mat4, NodePath, PandaNode, CollisionNode, CollisionTube, CollideMask
+
+# other imports
+import numpy as np
+
+# Workbench imports
+from Stats import Stats
+
+
+class CollisionTubes:
+	'''
+	Collision tubes (capsules) as arrays (n, 7): start point, end point & radius of every tube.
+	Many tubes are arranged to bounding volume hierarchy of nested nodes: collision traverser tests
+	the bounding volumes of the nodes first, so ray & sphere queries skip far tubes by the whole subtrees.
+	'''
+
+	@staticmethod
+	def add_solids(node: CollisionNode, tubes: np.ndarray) -> None:
+		for ax, ay, az, bx, by, bz, radius in np.asarray(tubes, np.float32).reshape(-1, 7).tolist():
+			node.add_solid(CollisionTube(Point3(ax, ay, az), Point3(bx, by, bz), radius))
+		if Stats.enabled:
+			Stats.count('collision solids', len(tubes))
+
+	@classmethod
+	def make_node(cls, tubes: np.ndarray, name = 'Collision') -> CollisionNode:
+		'returns collision node of the tubes; the node is "into" only'
+		ret = CollisionNode(name)
+		ret.set_from_collide_mask(CollideMask.all_off())
+		cls.add_solids(ret, tubes)
+		return ret
+
+	@classmethod
+	def make_hierarchy(cls, tubes: np.ndarray, leaf_size = 8, name = 'Collision') -> NodePath:
+		'''returns bounding volume hierarchy of the tubes: tubes are split by the median of the longest axis of their centers
+		until the node holds up to leaf_size tubes
+		'''
+		tubes = np.asarray(tubes, np.float32)
+		if len(tubes) <= leaf_size:
+			return NodePath(cls.make_node(tubes, name))
+		ret = NodePath(PandaNode(name))
+		centers = (tubes[:, :3] + tubes[:, 3:6]) / 2
+		order = np.argsort(centers[:, np.argmax(np.ptp(centers, axis=0))], kind='stable')
+		half = len(tubes) // 2
+		for rows in (order[:half], order[half:]):
+			cls.make_hierarchy(tubes[rows], leaf_size, name).reparent_to(ret)
+		return ret
+
+	@staticmethod
+	def transform(tubes: np.ndarray, mat: Mat4) -> np.ndarray:
+		'returns the tubes transformed by the matrix; the matrix scale should be uniform'
+		mat = np.array(mat, np.float32).reshape(4, 4)
+		ret = np.empty_like(tubes)
+		ret[:, :3] = tubes[:, :3] @ mat[:3, :3] + mat[3, :3]
+		ret[:, 3:6] = tubes[:, 3:6] @ mat[:3, :3] + mat[3, :3]
+		ret[:, 6] = tubes[:, 6] * np.linalg.norm(mat[0, :3])
+		return ret
@@ -0,0 +1,102 @@
+
+# python imports
+from typing import Iterator, Optional, Callable, Deque, Tuple, Any
+from collections import deque
+import time
+
+
+class FrameScheduler:
+	'''
+	Cooperative scheduler of resumable jobs: job is a generator doing one small step of work per next() call,
+	the value returned by the generator is the job result.
+	Task manager task runs the steps of jobs in order until the per-frame time budget is spent;
+	at least one step is run every frame, so a step should be shorter than the budget.
+	A job waiting for the next frame rendering (for example of one-shot offscreen buffer) yields NEXT_FRAME:
+	the job is set aside until the next frame, the other jobs take the rest of the budget.
+	'''
+
+	NEXT_FRAME = object() # yielded by a job: the job steps are resumed after the next frame is rendered
+
+	def __init__(self, budget_ms: float = 4, progress: Optional[Callable[[int, int], None]] = None, name = 'Frame Scheduler'):
+		'''
+		budget_ms -:- time of jobs steps per frame, milliseconds; can be changed at any time
+		progress -:- called with done & total jobs count when a job is done
+		'''
+		self.budget_ms, self.progress, self.name = budget_ms, progress, name
+		self.jobs: Deque[Tuple[Iterator, Optional[Callable[[Any], None]]]] = deque()
+		self.done_count = self.total_count = 0
+		self.task = None
+
+	def __len__(self) -> int:
+		'returns count of not done jobs'
+		return len(self.jobs)
+
+	def add(self, job: Iterator, on_done: Optional[Callable[[Any], None]] = None) -> None:
+		'''appends the job
+		on_done -:- called with the job result
+		'''
+		self.jobs.append((job, on_done))
+		self.total_count += 1
+
+	def run_steps(self, budget_ms: Optional[float] = None) -> bool:
+		'''runs the jobs steps until the time budget is spent
+		Returns True if there are not done jobs
+		'''
+		deadline = time.perf_counter() + (self.budget_ms if budget_ms is None else budget_ms) / 1000
+		deferred = [] # jobs waiting for the next frame
+		while self.jobs:
+			job, on_done = self.jobs.popleft()
+			try:
+				if next(job) is self.NEXT_FRAME:
+					deferred.append((job, on_done))
+				else:
+					self.jobs.appendleft((job, on_done))
+			except StopIteration as e:
+				self.done_count += 1
+				if on_done:
+					on_done(e.value)
+				if self.progress:
+					self.progress(self.done_count, self.total_count)
+			if time.perf_counter() >= deadline:
+				break
+		self.jobs.extendleft(reversed(deferred)) # waiting jobs are resumed first
+		return bool(self.jobs)
+
+	def run(self) -> None:
+		'runs all jobs to the end without the time budget; frames waited by the jobs are rendered at once'
+		while self.run_steps(float('inf')): # without the budget steps are stopped when all not done jobs wait for the next frame
+			base.graphicsEngine.render_frame()
+
+	@staticmethod
+	def complete(job: Iterator) -> Any:
+		'runs the job to the end; returns the job result; frames waited by the job are rendered at once'
+		while True:
+			try:
+				if next(job) is FrameScheduler.NEXT_FRAME:
+					base.graphicsEngine.render_frame()
+			except StopIteration as e:
+				return e.value
+
+	def start(self, task_mgr = None, sort = 0) -> None:
+		'''starts the task running jobs steps every frame
+		task_mgr -:- None - base.taskMgr
+		'''
+		if self.task is None:
+			self.task = (task_mgr or base.taskMgr).add(self.frame_task, self.name, sort)
+
+	def stop(self) -> None:
+		'stops the task; not done jobs are kept'
+		if self.task is not None:
+			self.task.remove()
+			self.task = None
+
+	def clear(self) -> None:
+		'drops not done jobs'
+		for job, _ in self.jobs:
+			job.close()
+		self.jobs.clear()
+		self.done_count = self.total_count = 0
+
+	def frame_task(self, task):
+		self.run_steps()
+		return task.cont
@@ -0,0 +1,276 @@
+
+# python imports
+from typing import Iterator, Optional, List, Tuple, NamedTuple
+from concurrent.futures import ProcessPoolExecutor, Future, wait
+from multiprocessing import get_context
+import hashlib
+import math
+import os
+import tempfile
+
+# Panda3D imports
+from panda3d.core import Vec2, Vec3, PNMImage, Texture
+
+# other imports
+import numpy as np
+
+# Workbench imports
+from FrameScheduler import FrameScheduler
+
+
+class TerrainNoise(NamedTuple):
+	'''
+	Seedable fractal gradient noise of the terrain heights.
+	Value of a point does not depend on the tile it is computed at, so tiles of the terrain can be computed separately.
+	'''
+	seed: int = 0
+	frequency: float = 1 / 128 # first octave noise cells per pixel
+	octaves: int = 6
+	persistence: float = .5 # amplitude factor of the next octave
+	lacunarity: float = 2. # frequency factor of the next octave
+
+	@staticmethod
+	def get_gradient_noise(x: np.ndarray, y: np.ndarray, seed: int) -> np.ndarray:
+		'returns Perlin gradient noise -1..1 of the points; the noise period is 256 cells'
+		rng = np.random.default_rng(seed)
+		permutation = np.tile(rng.permutation(256), 2)
+		angles = rng.random(256) * 2 * math.pi
+		gradients_x, gradients_y = np.cos(angles), np.sin(angles)
+		x0, y0 = np.floor(x), np.floor(y)
+		fx, fy = x - x0, y - y0
+		ix, iy = x0.astype(np.int64) & 255, y0.astype(np.int64) & 255
+
+		def corner(dx: int, dy: int) -> np.ndarray:
+			g = permutation[permutation[ix + dx] + iy + dy]
+			return gradients_x[g] * (fx - dx) + gradients_y[g] * (fy - dy)
+
+		u, v = (fx * fx * fx * (fx * (fx * 6 - 15) + 10)), (fy * fy * fy * (fy * (fy * 6 - 15) + 10)) # fade curves
+		bottom = corner(0, 0) + (corner(1, 0) - corner(0, 0)) * u
+		top = corner(0, 1) + (corner(1, 1) - corner(0, 1)) * u
+		return (bottom + (top - bottom) * v) * math.sqrt(2)
+
+	def get_values(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+		'returns heights 0..1 of the points, pixels coordinates'
+		ret, frequency, amplitude, amplitudes = np.zeros(np.shape(x)), self.frequency, 1., 0.
+		for octave in range(self.octaves):
+			ret += self.get_gradient_noise(x * frequency, y * frequency, self.seed * self.octaves + octave) * amplitude
+			amplitudes += amplitude
+			frequency, amplitude = frequency * self.lacunarity, amplitude * self.persistence
+		return np.clip(ret / amplitudes * .5 + .5, 0, 1)
+
+
+def fill_tile(path: str, columns: int, rows: int, noise: TerrainNoise, column: int, row: int, tile_size: int) -> None:
+	'process pool worker: writes heights of the tile to the raw 16-bit heightfield file'
+	heights = np.memmap(path, np.uint16, 'r+', shape=(rows, columns))
+	fill_heights(heights, noise, column, row, tile_size)
+	heights.flush()
+
+
+def fill_heights(heights: np.ndarray, noise: TerrainNoise, column: int, row: int, tile_size: int) -> None:
+	'writes 16-bit heights of the tile to the heightfield array'
+	y, x = np.mgrid[row:min(row + tile_size, heights.shape[0]), column:min(column + tile_size, heights.shape[1])]
+	heights[row:row + tile_size, column:column + tile_size] = np.rint(noise.get_values(x, y) * 65535)
+
+
+class Heightfield:
+	'''
+	Terrain heightfield as NumPy array: heights, slopes & normals of many points by one call,
+	scattering of points with Poisson-disk spacing and slope rejection.
+
+	Heights are mapped to the terrain like ShaderTerrainMesh does: the heightfield texture covers
+	the terrain area from pos to pos + size.xy, texel centers are at (i + .5) / texture size, height is scaled by size.z.
+
+	Generated heightfields are cached as raw 16-bit files and memory-mapped: the terrain pages are read on demand.
+	'''
+
+	VERSION = 1 # change to invalidate heightfields generated by previous noise code
+	CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+
+	def __init__(self, heights: np.ndarray, pos: Vec2, size: Vec3):
+		'''
+		heights -:- (rows, columns) heights: unsigned integers or normalized floats 0..1; the first row is the terrain bottom side (pos.y)
+		pos -:- terrain corner position
+		size -:- terrain size & height scale
+		'''
+		self.heights = heights if isinstance(heights, np.ndarray) else np.asarray(heights, np.float32)
+		self.pos, self.size = Vec2(pos), Vec3(size)
+		self.rows, self.columns = self.heights.shape
+		# heights values to terrain units
+		self.height_scale = self.size.z / (np.iinfo(self.heights.dtype).max if self.heights.dtype.kind == 'u' else 1)
+		# texels per terrain unit
+		self.scale_x, self.scale_y = self.columns / self.size.x, self.rows / self.size.y
+
+	@classmethod
+	def from_texture(cls, texture: Texture, pos: Vec2, size: Vec3) -> 'Heightfield':
+		'makes heightfield from the first component of the texture RAM image'
+		dtype = {1: np.uint8, 2: np.uint16, 4: np.float32}[texture.get_component_width()]
+		heights = np.frombuffer(memoryview(texture.get_ram_image()), dtype).reshape(
+			texture.get_y_size(), texture.get_x_size(), texture.get_num_components())[..., 0]
+		return cls(heights, pos, size)
+
+	@classmethod
+	def from_image(cls, image: PNMImage, pos: Vec2, size: Vec3) -> 'Heightfield':
+		'makes heightfield from the image gray channel'
+		texture = Texture()
+		texture.load(image)
+		return cls.from_texture(texture, pos, size)
+
+	def get_texel_coords(self, x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+		'returns column & row of the bottom left texel and fractions of the terrain points'
+		fx = np.clip((np.asarray(x, np.float32) - self.pos.x) * self.scale_x - .5, 0, self.columns - 1)
+		fy = np.clip((np.asarray(y, np.float32) - self.pos.y) * self.scale_y - .5, 0, self.rows - 1)
+		column, row = np.minimum(fx.astype(np.int32), self.columns - 2), np.minimum(fy.astype(np.int32), self.rows - 2)
+		return column, row, fx - column, fy - row
+
+	def sample(self, x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+		'''returns bilinear heights (n, ), slopes (n, ) as rise over run & unit normals (n, 3) of the terrain points
+		x, y -:- (n, ) terrain points coordinates
+		'''
+		column, row, tx, ty = self.get_texel_coords(x, y)
+		h00, h10 = self.heights[row, column].astype(np.float32), self.heights[row, column + 1].astype(np.float32)
+		h01, h11 = self.heights[row + 1, column].astype(np.float32), self.heights[row + 1, column + 1].astype(np.float32)
+		bottom, top = h00 + (h10 - h00) * tx, h01 + (h11 - h01) * tx
+		heights = (bottom + (top - bottom) * ty) * self.height_scale
+		# derivatives of the bilinear patch
+		dx = ((h10 - h00) * (1 - ty) + (h11 - h01) * ty) * (self.height_scale * self.scale_x)
+		dy = (top - bottom) * (self.height_scale * self.scale_y)
+		normals = np.stack((-dx, -dy, np.ones_like(dx)), axis=-1)
+		normals /= np.linalg.norm(normals, axis=-1, keepdims=True)
+		return heights, np.hypot(dx, dy), normals
+
+	def get_heights(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+		return self.sample(x, y)[0]
+
+	def get_slopes(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+		return self.sample(x, y)[1]
+
+	def get_normals(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+		return self.sample(x, y)[2]
+
+	def poisson_disk(self, min_distance: float, rng: Optional[np.random.Generator] = None, attempts = 8) -> np.ndarray:
+		'''returns (n, 2) terrain points not closer than min_distance to each other (blue noise)
+		Points are thrown to the background grid of min_distance / sqrt(2) cells, one point per cell;
+		cells of the same phase (row % 3, column % 3) are far enough from each other to be thrown by one vectorized pass.
+		attempts -:- passes over empty cells: more passes - denser points
+		'''
+		rng = rng or np.random.default_rng()
+		cell = min_distance / math.sqrt(2)
+		columns, rows = max(int(self.size.x // cell), 1), max(int(self.size.y // cell), 1)
+		points = np.full((rows + 4, columns + 4, 2), np.nan, np.float32) # 2 cells border for neighbours lookup
+		grid_row, grid_column = np.mgrid[0:rows, 0:columns]
+		offsets = [(i, j) for i in range(-2, 3) for j in range(-2, 3) if (i, j) != (0, 0)]
+		for _ in range(attempts):
+			for phase_row in range(3):
+				for phase_column in range(3):
+					r = grid_row[phase_row::3, phase_column::3].ravel()
+					c = grid_column[phase_row::3, phase_column::3].ravel()
+					empty = np.isnan(points[r + 2, c + 2, 0])
+					r, c = r[empty], c[empty]
+					candidates = (np.stack((c, r), axis=-1) + rng.random((len(r), 2))) * cell
+					ok = np.ones(len(r), bool)
+					for i, j in offsets:
+						distance = np.linalg.norm(points[r + 2 + i, c + 2 + j] - candidates, axis=-1)
+						ok &= ~(distance < min_distance) # NaN - empty cell
+					points[r[ok] + 2, c[ok] + 2] = candidates[ok]
+		points = points[2:-2, 2:-2].reshape(-1, 2)
+		points = points[~np.isnan(points[:, 0])]
+		points = points[(points[:, 0] < self.size.x) & (points[:, 1] < self.size.y)]
+		return points + np.array((self.pos.x, self.pos.y), np.float32)
+
+	def scatter(self, min_distance: float, max_slope: Optional[float] = None, rng: Optional[np.random.Generator] = None,
+			attempts = 8) -> Tuple[np.ndarray, np.ndarray]:
+		'''returns (n, 3) terrain points with Poisson-disk spacing & their unit normals (n, 3)
+		max_slope -:- points with steeper slope (rise over run) are rejected; None - no rejection
+		'''
+		points = self.poisson_disk(min_distance, rng, attempts)
+		heights, slopes, normals = self.sample(points[:, 0], points[:, 1])
+		keep = slice(None) if max_slope is None else slopes <= max_slope
+		return np.column_stack((points, heights))[keep], normals[keep]
+
+	def get_texture(self, name = 'heightfield') -> Texture:
+		'returns 16-bit luminance texture of the heights, for example ShaderTerrainMesh heightfield'
+		heights = self.heights
+		if heights.dtype != np.uint16:
+			heights = np.rint(heights.astype(np.float32) * (65535 * self.height_scale / self.size.z)).astype(np.uint16)
+		texture = Texture(name)
+		texture.setup_2d_texture(self.columns, self.rows, Texture.T_unsigned_short, Texture.F_luminance)
+		texture.set_ram_image(np.ascontiguousarray(heights))
+		return texture
+
+	@classmethod
+	def get_cache_key(cls, columns: int, rows: int, noise: TerrainNoise) -> str:
+		return hashlib.sha256(repr((cls.VERSION, columns, rows, tuple(noise))).encode()).hexdigest()
+
+	@classmethod
+	def iter_generate(cls, columns: int, rows: int, noise: TerrainNoise, pos: Vec2, size: Vec3,
+			cache_path: Optional[str] = CACHE_PATH, tile_size = 512, max_workers: Optional[int] = 0,
+			wait_workers = False) -> Iterator:
+		'''job generating the heightfield by tiles; returns Heightfield of memory-mapped raw 16-bit file
+		Heightfield generated before with the same size & noise is loaded from the cache without generation.
+		columns, rows -:- heightfield size, pixels
+		cache_path -:- cache directory; None - not cached, heights are generated to memory
+		max_workers -:- process pool size for tiles generation; 0 - tiles are generated by this process step by step
+		wait_workers -:- block until the process pool workers are done (see generate);
+			False - yields FrameScheduler.NEXT_FRAME while the workers generate the tiles
+		'''
+		tiles = [(column, row) for row in range(0, rows, tile_size) for column in range(0, columns, tile_size)]
+		if cache_path is None:
+			if max_workers == 0:
+				heights = np.empty((rows, columns), np.uint16)
+				for column, row in tiles:
+					fill_heights(heights, noise, column, row, tile_size)
+					yield
+				return cls(heights, pos, size)
+			# workers write the tiles to temporary file, the heights are read to memory
+			fd, tmp_path = tempfile.mkstemp('.r16')
+			os.close(fd)
+			try:
+				yield from cls.iter_fill_tiles(tmp_path, columns, rows, noise, tiles, tile_size, max_workers, wait_workers)
+				return cls(np.fromfile(tmp_path, np.uint16).reshape(rows, columns), pos, size)
+			finally:
+				os.remove(tmp_path)
+		file_path = os.path.join(cache_path, f'heightfield.{cls.get_cache_key(columns, rows, noise)}.r16')
+		if not os.path.isfile(file_path):
+			os.makedirs(cache_path, exist_ok=True)
+			# write to temporary file first: interrupted generation should not leave broken file
+			tmp_path = f'{file_path}.{os.getpid()}.tmp'
+			try:
+				yield from cls.iter_fill_tiles(tmp_path, columns, rows, noise, tiles, tile_size, max_workers, wait_workers)
+				os.replace(tmp_path, file_path)
+			finally:
+				if os.path.isfile(tmp_path):
+					os.remove(tmp_path)
+		return cls(np.memmap(file_path, np.uint16, 'r', shape=(rows, columns)), pos, size)
+
+	@staticmethod
+	def iter_fill_tiles(path: str, columns: int, rows: int, noise: TerrainNoise, tiles: List[Tuple[int, int]], tile_size: int,
+			max_workers: Optional[int], wait_workers: bool) -> Iterator:
+		'job writing the tiles to new raw 16-bit heightfield file; see iter_generate()'
+		np.memmap(path, np.uint16, 'w+', shape=(rows, columns)).flush()
+		if max_workers == 0:
+			for column, row in tiles:
+				fill_tile(path, columns, rows, noise, column, row, tile_size)
+				yield
+			return
+		with ProcessPoolExecutor(max_workers, get_context('spawn')) as pool:
+			futures: List[Future] = [pool.submit(fill_tile, path, columns, rows, noise, column, row, tile_size)
+				for column, row in tiles]
+			try:
+				if wait_workers:
+					wait(futures)
+				else:
+					# polling is not repeated within the frame: the frame budget is left to other jobs
+					while not all(future.done() for future in futures):
+						yield FrameScheduler.NEXT_FRAME
+			finally:
+				for future in futures:
+					future.cancel()
+			for future in futures:
+				future.result() # raise worker exception
+
+	@classmethod
+	def generate(cls, columns: int, rows: int, noise: TerrainNoise, pos: Vec2, size: Vec3,
+			cache_path: Optional[str] = CACHE_PATH, tile_size = 512, max_workers: Optional[int] = 0) -> 'Heightfield':
+		'generates the heightfield or loads it from the cache; see iter_generate()'
+		return FrameScheduler.complete(cls.iter_generate(columns, rows, noise, pos, size, cache_path, tile_size, max_workers,
+			wait_workers=True))
@@ -0,0 +1,61 @@
+
+# python imports
+from typing import Optional
+
+# Panda3D imports
+from panda3d.core import Point3, NodePath, Texture, Geom, BoundingBox, BoundingVolume
+
+# other imports
+import numpy as np
+
+
+class InstanceBuffer:
+	'''
+	Per-instance data of instanced draw call packed to buffer texture of RGBA32 float texels & read by the vertex shader:
+	every instance takes stride texels, the first 4 texels are the rows of the instance Panda3D matrix,
+	the next texels are any other instance data (for example label layer).
+	Panda3D multiplies row vectors by matrices (v * M), GLSL multiplies matrices by column vectors (M * v),
+	so the matrix rows are the columns of GLSL matrix and the shader takes the transform as is:
+	mat4(texelFetch(buffer, row), texelFetch(buffer, row + 1), texelFetch(buffer, row + 2), texelFetch(buffer, row + 3)) * p3d_Vertex
+	'''
+
+	@staticmethod
+	def set_rows(texture: Texture, rows: np.ndarray) -> None:
+		'''loads instances texels to the buffer texture
+		rows -:- (n, stride, 4) texels of instances
+		'''
+		rows = np.ascontiguousarray(rows, np.float32)
+		texture.setup_buffer_texture(max(len(rows), 1) * rows.shape[1], Texture.T_float, Texture.F_rgba32, Geom.UH_static)
+		texture.set_ram_image(rows.tobytes() if len(rows) else bytes(rows.shape[1] * 4 * 4))
+
+	@staticmethod
+	def get_rows(texture: Texture, count: int, stride = 4) -> np.ndarray:
+		'returns copy of texels (count, stride, 4) of the buffer texture'
+		return np.frombuffer(memoryview(texture.get_ram_image()), np.float32).reshape(-1, stride, 4)[:count].copy()
+
+	@staticmethod
+	def get_bounds(matrices: np.ndarray, model_bounds: BoundingVolume) -> BoundingBox:
+		'returns box bounding the model bounds at every instance position'
+		if not len(matrices):
+			return BoundingBox()
+		radius = 0 if model_bounds.is_empty() else (model_bounds.get_center().length() + model_bounds.get_radius()) \
+			* np.linalg.norm(matrices[:, 0, :3], axis=1).max()
+		pos = matrices[:, 3, :3]
+		return BoundingBox(Point3(*(pos.min(axis=0) - radius)), Point3(*(pos.max(axis=0) + radius)))
+
+	@classmethod
+	def set_instances(cls, node_np: NodePath, texture: Texture, matrices: np.ndarray, model_bounds: BoundingVolume,
+			data: Optional[np.ndarray] = None) -> None:
+		'''replaces instances of the node: loads the buffer texture, sets instance count & user bounds of the node;
+		the node is hidden without instances
+		matrices -:- (n, 4, 4) transforms of instances relative to the node
+		data -:- (n, k, 4) other texels of instances following the matrices rows; None - matrices only
+		'''
+		cls.set_rows(texture, matrices if data is None else np.concatenate((matrices, data), axis=1))
+		node_np.set_instance_count(len(matrices))
+		node_np.node().set_bounds(cls.get_bounds(matrices, model_bounds))
+		node_np.node().set_final(True)
+		if len(matrices):
+			node_np.show()
+		else:
+			node_np.hide()
@@ -0,0 +1,111 @@
+
+# python imports
+from typing import Iterable
+from functools import lru_cache
+import math
+
+# Panda3D imports
+from panda3d.core import Geom, GeomPrimitive, GeomVertexData, PTA_int
+
+# other imports
+import numpy as np
+
+# Workbench imports
+from Stats import Stats
+
+
+class RingMesh:
+	'''
+	Vectorized tessellation of cylinder side rings (lathe) to vertex format V3N3T2.
+	Rings are computed as NumPy arrays and written to Panda3D buffers by one copy.
+
+	Cylinder side circle is added slice by slice; face side vertex order is left to right ->
+	Example for ring{pos=(0, 0, 0) radius=1 perp1=(1, 0, 0) perp2=(0, 1, 0)} num_side_slices = 4:
+	vertexes positions: (1, 0, 0), (0, 1, 0), (-1, 0, 0), (0, -1, 0), (1, 0, 0)
+	texture UV coords:  (0, v),    (0.25, v), (0.5, v),   (0.75, v),  (1, v)
+	The last vertex doubles the first one to fix UV seam.
+	'''
+
+	VERTEX_STRIDE = 8 # V3N3T2 floats
+
+	@staticmethod
+	@lru_cache(maxsize=None)
+	def get_slices_table(num_side_slices: int) -> np.ndarray:
+		'returns cos, sin & texture U coord of ring vertexes'
+		angle = np.arange(num_side_slices + 1) * (2 * math.pi / num_side_slices)
+		ret = np.stack((np.cos(angle), np.sin(angle), np.arange(num_side_slices + 1) / num_side_slices))
+		ret.flags.writeable = False
+		return ret
+
+	@classmethod
+	def make_rings(cls, pos: np.ndarray, perp1: np.ndarray, perp2: np.ndarray, radius: np.ndarray,
+			tex_v: np.ndarray, num_side_slices: int) -> np.ndarray:
+		'''returns vertex rows of the rings: (len(pos) * (num_side_slices + 1), 8)
+		pos, perp1, perp2 -:- (n, 3) ring centers and unit vectors of the ring plane
+		radius, tex_v -:- (n, ) ring radiuses and texture V coords
+		'''
+		cos, sin, tex_u = cls.get_slices_table(num_side_slices)
+		pos, perp1, perp2 = (np.asarray(x, np.float32).reshape(-1, 1, 3) for x in (pos, perp1, perp2))
+		normal = perp1 * cos[:, None] + perp2 * sin[:, None]
+		rows = np.empty((len(pos), num_side_slices + 1, cls.VERTEX_STRIDE), np.float32)
+		rows[..., 0:3] = pos + normal * np.asarray(radius, np.float32).reshape(-1, 1, 1)
+		rows[..., 3:6] = normal
+		rows[..., 6] = tex_u
+		rows[..., 7] = np.asarray(tex_v, np.float32).reshape(-1, 1)
+		return rows.reshape(-1, cls.VERTEX_STRIDE)
+
+	@staticmethod
+	def append_rows(vdata: GeomVertexData, rows: np.ndarray) -> int:
+		'''appends V3N3T2 rows to the vertex data by one copy
+		Returns index of the first added row
+		'''
+		start = vdata.get_num_rows()
+		array = vdata.modify_array(0)
+		array.set_num_rows(start + len(rows))
+		memoryview(array).cast('B')[start * rows.strides[0]:] = memoryview(np.ascontiguousarray(rows, np.float32)).cast('B')
+		if Stats.enabled:
+			Stats.count('vertex rows', len(rows))
+		return start
+
+	@staticmethod
+	def get_strips_indices(first_rows: Iterable[int], num_side_slices: int) -> np.ndarray:
+		'''returns vertex indexes of tristrips connecting ring pairs: (len(first_rows), 2 * (num_side_slices + 2))
+		Example vertex indexes for num_side_slices = 4:
+		5 6 7 8 9 # second circle
+		0 1 2 3 4 # first circle
+		'''
+		i = np.asarray(first_rows, np.int64).reshape(-1, 1) + np.arange(num_side_slices + 2)
+		return np.stack((i + num_side_slices, i), axis=-1).reshape(len(i), -1)
+
+	@classmethod
+	def add_strips(cls, primitive: GeomPrimitive, first_rows: Iterable[int], num_side_slices: int) -> None:
+		'''appends tristrips connecting ring pairs to GeomTristrips by one copy
+		Same as add_vertex() & close_primitive() for every strip
+		'''
+		strips = cls.get_strips_indices(first_rows, num_side_slices)
+		if not len(strips):
+			return
+		count, strip_len = strips.shape
+		num_vertices = primitive.get_num_vertices()
+		# degenerate vertexes between strips: last vertex of previous strip & first vertex of next strip
+		indices = np.empty((count, strip_len + 2), np.int64)
+		indices[:, 2:] = strips
+		indices[:, 0] = np.roll(strips[:, -1], 1)
+		indices[:, 1] = strips[:, 0]
+		if num_vertices:
+			indices[0, 0] = primitive.get_vertex(num_vertices - 1)
+			indices = indices.reshape(-1)
+		else:
+			indices = indices.reshape(-1)[2:]
+		if indices.max() > 0xffff and primitive.get_index_type() != Geom.NT_uint32:
+			primitive.set_index_type(Geom.NT_uint32)
+		index_type = np.uint32 if primitive.get_index_type() == Geom.NT_uint32 else np.uint16
+		vertices = primitive.modify_vertices()
+		vertices.set_num_rows(num_vertices + len(indices))
+		memoryview(vertices).cast('B')[num_vertices * np.dtype(index_type).itemsize:] = memoryview(indices.astype(index_type)).cast('B')
+		# ends of strips at vertex indexes array
+		ends = np.arange(num_vertices + len(indices) - (count - 1) * (strip_len + 2), num_vertices + len(indices) + 1, strip_len + 2)
+		primitive.set_ends(PTA_int(list(primitive.get_ends()) + ends.tolist()))
+		if Stats.enabled:
+			Stats.count('primitives', count)
+			Stats.count('triangles', count * num_side_slices * 2)
@@ -0,0 +1,153 @@
+
+# python imports
+from typing import Optional, Dict, List, Set, Tuple, Callable, Union, TextIO
+from functools import wraps
+import builtins
+import json
+import sys
+import time
+
+# Panda3D imports
+from panda3d.core import PStatCollector
+
+
+class Stats:
+	'''
+	Instrumentation of the generators: wall time of calls & counters (vertex rows, primitives, GeomNodes, branches, ends, leaves).
+	Values are visible at PStats as "Workbench" collectors and as Python dict by get() & dump();
+	PStats shows counters values counted per frame, the dict holds the totals.
+
+	Disabled instrumentation is free: methods decorated by Stats.timed are the original functions
+	until enable() replaces them by timing wrappers; counters are guarded by "if Stats.enabled:" at call sites.
+	'''
+
+	enabled = False
+	times: Dict[str, List[float]] = {} # name: [calls, total time, max time]
+	counters: Dict[str, float] = {}
+	levels: Dict[str, float] = {}
+	collectors: Dict[str, PStatCollector] = {}
+	frame_counters: Set[str] = set() # counters changed at the current frame: PStats levels are reset by the task
+	task = None
+	timed_methods: List[Tuple[type, str, Callable, str]] = [] # owner class, attribute name, function, stat name
+
+	class timed:
+		'''methods decorator: wall time of the method calls is recorded while the instrumentation is enabled
+		name -:- stat name; None - qualified name of the method
+		'''
+
+		def __init__(self, func: Optional[Callable] = None, name: Optional[str] = None):
+			self.func, self.name = func, name
+
+		def __call__(self, func: Callable) -> 'Stats.timed':
+			# used as @Stats.timed(name=...)
+			self.func = func
+			return self
+
+		def __set_name__(self, owner: type, name: str) -> None:
+			# place the original function to the class; timing wrapper is placed by Stats.enable()
+			setattr(owner, name, self.func)
+			Stats.timed_methods.append((owner, name, self.func, self.name or self.func.__qualname__))
+			if Stats.enabled:
+				setattr(owner, name, Stats.wrap(self.func, self.name or self.func.__qualname__))
+
+	@classmethod
+	def wrap(cls, func: Callable, name: str) -> Callable:
+		'returns timing wrapper of the function'
+		collector = cls.get_collector(name)
+
+		@wraps(func)
+		def wrapper(*args, **kwargs):
+			collector.start()
+			start = time.perf_counter()
+			try:
+				return func(*args, **kwargs)
+			finally:
+				duration = time.perf_counter() - start
+				collector.stop()
+				stat = cls.times.setdefault(name, [0, 0., 0.])
+				stat[0] += 1
+				stat[1] += duration
+				stat[2] = max(stat[2], duration)
+		return wrapper
+
+	@classmethod
+	def enable(cls, enabled = True) -> None:
+		'enables or disables the instrumentation'
+		cls.enabled = enabled
+		for owner, attr, func, name in cls.timed_methods:
+			setattr(owner, attr, cls.wrap(func, name) if enabled else func)
+		if not enabled:
+			cls.stop()
+		elif hasattr(builtins, 'base'):
+			cls.start()
+
+	@classmethod
+	def get_collector(cls, name: str) -> PStatCollector:
+		if (ret := cls.collectors.get(name)) is None:
+			ret = cls.collectors[name] = PStatCollector(f'Workbench:{name}')
+		return ret
+
+	@classmethod
+	def count(cls, name: str, value: float = 1) -> None:
+		'adds the value to the counter (for example added vertex rows)'
+		cls.counters[name] = cls.counters.get(name, 0) + value
+		cls.get_collector(name).add_level_now(value)
+		cls.frame_counters.add(name)
+
+	@classmethod
+	def level(cls, name: str, value: float) -> None:
+		'sets the current value (for example number of the tree ends)'
+		cls.levels[name] = value
+		cls.get_collector(name).set_level(value)
+
+	@classmethod
+	def reset(cls) -> None:
+		cls.times.clear()
+		cls.counters.clear()
+		cls.levels.clear()
+		cls.frame_counters.clear()
+		for collector in cls.collectors.values():
+			collector.clear_level()
+
+	@classmethod
+	def start(cls, task_mgr = None) -> None:
+		'''starts the task resetting PStats levels of the counters every frame; enable() starts it if ShowBase is created
+		task_mgr -:- None - base.taskMgr
+		'''
+		if cls.task is None:
+			# after igLoop: the frame levels are sent to PStats by the frame rendering
+			cls.task = (task_mgr or base.taskMgr).add(cls.frame_task, 'Stats', sort=51)
+
+	@classmethod
+	def stop(cls) -> None:
+		if cls.task is not None:
+			cls.task.remove()
+			cls.task = None
+
+	@classmethod
+	def frame_task(cls, task):
+		for name in cls.frame_counters:
+			cls.collectors[name].set_level(0)
+		cls.frame_counters.clear()
+		return task.cont
+
+	@classmethod
+	def get(cls) -> dict:
+		'returns recorded values: calls, total, mean & max time of the methods (seconds), counters & levels'
+		return {
+			'times': {name: {'calls': calls, 'total': total, 'mean': total / calls if calls else 0, 'max': max_}
+				for name, (calls, total, max_) in cls.times.items()},
+			'counters': dict(cls.counters),
+			'levels': dict(cls.levels),
+		}
+
+	@classmethod
+	def dump(cls, file: Union[str, TextIO, None] = None) -> None:
+		'''writes recorded values as JSON
+		file -:- file path or text stream; None - stdout
+		'''
+		if isinstance(file, str):
+			with open(file, 'w') as f:
+				json.dump(cls.get(), f, indent='\t')
+		else:
+			json.dump(cls.get(), file or sys.stdout, indent='\t')
@@ -0,0 +1,104 @@
+'''
+Offline bake of textures images to .txo files with precomputed mipmaps:
+python3 TextureBake.py ../bottle/textures/*.png ../tree/models/barkTexture.jpg ../tree/terrain/texture.grass.jpg --compression dxt5
+'''
+
+# python imports
+from typing import Iterable, List, Dict, Tuple
+import os
+import hashlib
+import threading
+
+# Panda3D imports
+from panda3d.core import Filename, Texture
+
+# Workbench imports
+from TextureLoader import TextureLoader
+from Stats import Stats
+
+
+class TextureBake:
+	'''
+	Cache of baked textures: source image decoded & scaled to power of 2, with mipmaps & optionally compressed,
+	is written to .txo file named by hash of the source file content & bake options, so the changed source image is baked again.
+	Baked texture is loaded by one read without images decoding & mipmaps generation.
+	'''
+
+	VERSION = 1 # change to invalidate textures baked by previous code
+	PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'textures')
+
+	def __init__(self, path: str = PATH, compression: int = Texture.CM_off):
+		'''
+		path -:- cache directory
+		compression -:- Texture.CM_*, for example Texture.CM_dxt5; compressed by the software compressor, no window is needed
+		'''
+		self.path, self.compression = path, compression
+		os.makedirs(path, exist_ok=True)
+		# source path: modification time, size & content hash; the source is hashed again only when changed
+		self.hashes: Dict[str, Tuple[int, int, str]] = {}
+
+	@staticmethod
+	def get_file_hash(file_path: str) -> str:
+		ret = hashlib.sha256()
+		with open(file_path, 'rb') as f:
+			while chunk := f.read(2 ** 20):
+				ret.update(chunk)
+		return ret.hexdigest()
+
+	def get_source_hash(self, source_path: str) -> str:
+		'returns content hash of the source file; the hash is cached by the file modification time & size'
+		stat = os.stat(source_path)
+		if (cached := self.hashes.get(source_path)) is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+			return cached[2]
+		ret = self.get_file_hash(source_path)
+		self.hashes[source_path] = stat.st_mtime_ns, stat.st_size, ret
+		return ret
+
+	def get_key(self, source_path: str) -> str:
+		'returns cache key of the source image file'
+		return hashlib.sha256(repr((self.VERSION, self.get_source_hash(source_path), self.compression)).encode()).hexdigest()
+
+	def get(self, texture_path: str) -> str:
+		'''returns path of the baked texture; the texture is baked if absent
+		texture_path -:- source image path; relative path is found at model-path as base.loader does
+		'''
+		source_path = TextureLoader.resolve(texture_path).to_os_specific()
+		baked_path = os.path.join(self.path, f'{self.get_key(source_path)}.txo')
+		if not os.path.isfile(baked_path):
+			self.bake(source_path, baked_path)
+		return Filename.from_os_specific(baked_path).get_fullpath()
+
+	@Stats.timed
+	def bake(self, source_path: str, baked_path: str) -> None:
+		texture = Texture(os.path.splitext(os.path.basename(source_path))[0])
+		if not texture.read(Filename.from_os_specific(source_path)):
+			raise IOError(f'Could not load texture: {source_path}')
+		texture.generate_ram_mipmap_images()
+		if self.compression != Texture.CM_off and not texture.compress_ram_image(self.compression):
+			raise ValueError(f'Could not compress texture: {source_path}')
+		# write to temporary file first: interrupted write should not leave broken texture; threads may bake the same source
+		tmp_path = f'{baked_path}.{os.getpid()}.{threading.get_ident()}.tmp.txo'
+		if not texture.write(Filename.from_os_specific(tmp_path)):
+			raise IOError(f'can not write {baked_path}')
+		os.replace(tmp_path, baked_path)
+
+	def bake_all(self, texture_paths: Iterable[str]) -> List[str]:
+		'returns paths of the baked textures'
+		return [self.get(texture_path) for texture_path in texture_paths]
+
+	def clear(self) -> None:
+		for name in os.listdir(self.path):
+			if name.endswith('.txo'):
+				os.remove(os.path.join(self.path, name))
+
+
+if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser(description='Bakes textures images to .txo files with mipmaps')
+	parser.add_argument('textures', nargs='+', help='source images')
+	parser.add_argument('--compression', default='off', help='Texture compression mode: off, dxt1, dxt5, ...')
+	parser.add_argument('--path', default=TextureBake.PATH, help='cache directory')
+	args = parser.parse_args()
+	bake = TextureBake(args.path, Texture.string_compression_mode(args.compression))
+	for texture_path, baked_path in zip(args.textures, bake.bake_all(os.path.abspath(p) for p in args.textures)):
+		print(f'{texture_path} -> {Filename(baked_path).to_os_specific()}')
@@ -0,0 +1,151 @@
+
+# python imports
+from typing import Optional, Callable, Dict, List, Tuple
+from concurrent.futures import ThreadPoolExecutor, Future
+
+# Panda3D imports
+from panda3d.core import Filename, Texture, TexturePool, get_model_path
+from direct.directnotify.DirectNotifyGlobal import directNotify
+
+# Workbench imports
+from Stats import Stats
+
+
+class TextureLoader:
+	'''
+	Textures decoded by background threads: load() returns a placeholder texture at once,
+	the decoded image is loaded to the same Texture object by task manager task, so the nodes using the texture
+	show it when it is ready and scene switching does not freeze the frame.
+	Loaded textures are added to TexturePool: the next loads of the path are not decoded again.
+	The texture not decoded (absent or broken image file) is logged & stays placeholder.
+	'''
+
+	notify = directNotify.newCategory('TextureLoader')
+
+	def __init__(self, max_workers: Optional[int] = None, placeholder_color = (.5, .5, .5, 1), bake: Optional['TextureBake'] = None,
+			name = 'Texture Loader'):
+		'''
+		placeholder_color -:- color of the textures until loaded
+		bake -:- baked textures cache: the textures are baked (if absent) & loaded by background threads
+		'''
+		self.placeholder_color, self.bake, self.name = placeholder_color, bake, name
+		self.pool = ThreadPoolExecutor(max_workers, thread_name_prefix=name)
+		# resolved path: texture, decoding future, props & ready callbacks
+		self.pending: Dict[str, Tuple[Texture, Future, 'TextureProps', List[Callable[[Texture], None]]]] = {}
+		self.task = None
+
+	def __len__(self) -> int:
+		'returns count of not loaded textures'
+		return len(self.pending)
+
+	@staticmethod
+	def resolve(texture_path: str) -> Filename:
+		'returns the path found at model-path as base.loader does'
+		ret = Filename(texture_path)
+		ret.resolve_filename(get_model_path().get_value())
+		return ret
+
+	def decode(self, filename: Filename) -> Texture:
+		'background thread: returns the texture read as TexturePool does (scaled to power of 2, any texture file format)'
+		ret = Texture(filename.get_basename_wo_extension())
+		if self.bake is not None:
+			filename = Filename(self.bake.get(filename.get_fullpath()))
+		if not ret.read(filename):
+			raise IOError(f'Could not load texture: {filename}')
+		return ret
+
+	@staticmethod
+	def set_images(texture: Texture, source: Texture) -> None:
+		'replaces images of the texture by the source images; the images are shared, not copied'
+		texture.setup_texture(source.get_texture_type(), source.get_x_size(), source.get_y_size(), source.get_z_size(),
+			source.get_component_type(), source.get_format())
+		texture.set_ram_image(source.get_ram_image(), source.get_ram_image_compression(), source.get_ram_page_size())
+		for n in range(1, source.get_num_ram_mipmap_images()):
+			texture.set_ram_mipmap_image(n, source.get_ram_mipmap_image(n), source.get_ram_mipmap_page_size(n))
+
+	def load(self, props: 'TextureProps', on_ready: Optional[Callable[[Texture], None]] = None) -> Texture:
+		'''returns texture of the props; the texture is placeholder until the image is decoded
+		on_ready -:- called with the texture when it is loaded
+		'''
+		filename = self.resolve(props.path)
+		if TexturePool.has_texture(filename):
+			ret = TexturePool.load_texture(filename)
+			props.set_texture_props(ret)
+			if on_ready:
+				on_ready(ret)
+			return ret
+		if (pending := self.pending.get(filename.get_fullpath())) is None:
+			ret = Texture(filename.get_basename_wo_extension())
+			ret.setup_2d_texture(1, 1, Texture.T_unsigned_byte, Texture.F_rgba)
+			ret.set_clear_color(self.placeholder_color)
+			props.set_texture_props(ret)
+			pending = self.pending[filename.get_fullpath()] = ret, self.pool.submit(self.decode, filename), props, []
+			if Stats.enabled:
+				Stats.count('textures loading')
+			self.start()
+		if on_ready:
+			pending[3].append(on_ready)
+		return pending[0]
+
+	def reload(self, texture: Texture, props: 'TextureProps') -> None:
+		'reloads the texture in place from the props path by background thread, for example when the file is changed'
+		fullpath = self.resolve(props.path).get_fullpath()
+		if fullpath not in self.pending:
+			self.pending[fullpath] = texture, self.pool.submit(self.decode, Filename(fullpath)), props, []
+			self.start()
+
+	def apply(self, fullpath: str) -> None:
+		'sets decoded images to the texture; main thread'
+		texture, future, props, callbacks = self.pending.pop(fullpath)
+		try:
+			source = future.result()
+		except Exception as e:
+			self.notify.warning(f'{fullpath}: {e!r}')
+			return
+		self.set_images(texture, source)
+		# the source path even for baked texture: TexturePool finds the texture by the source path
+		texture.set_filename(Filename(fullpath))
+		texture.set_fullpath(Filename(fullpath))
+		texture.clear_clear_color()
+		props.set_texture_props(texture) # sampler settings are reset by setup
+		if not TexturePool.has_texture(texture.get_fullpath()): # reloaded texture is in the pool
+			TexturePool.add_texture(texture)
+		for on_ready in callbacks:
+			on_ready(texture)
+
+	def poll(self) -> None:
+		'loads decoded images; not decoded are kept'
+		for fullpath in [fullpath for fullpath, (_, future, _, _) in self.pending.items() if future.done()]:
+			self.apply(fullpath)
+
+	def wait(self) -> None:
+		'waits for all textures & loads them'
+		for fullpath in list(self.pending):
+			self.apply(fullpath)
+
+	def start(self, task_mgr = None) -> None:
+		'''starts the task polling decoded images every frame
+		task_mgr -:- None - base.taskMgr
+		'''
+		if self.task is None:
+			self.task = (task_mgr or base.taskMgr).add(self.frame_task, self.name)
+
+	def stop(self) -> None:
+		if self.task is not None:
+			self.task.remove()
+			self.task = None
+
+	def shutdown(self) -> None:
+		'stops the task & background threads; not loaded textures stay placeholders'
+		self.stop()
+		for _, future, _, _ in self.pending.values():
+			future.cancel()
+		self.pending.clear()
+		self.pool.shutdown()
+
+	def frame_task(self, task):
+		self.poll()
+		if self.pending:
+			return task.cont
+		self.task = None
+		return task.done
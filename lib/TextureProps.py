@@ -28,3 +28,20 @@ class TextureProps(NamedTuple):
 			np.set_tex_scale(ts, self.scale)
 		if np and self.transparency:
 			np.set_transparency(self.transparency)
+
+	def load(self, np: Optional['NodePath'] = None, ts: Optional['TextureStage'] = None,
+			loader: Optional['TextureLoader'] = None, bake: Optional['TextureBake'] = None) -> 'Texture':
+		'''returns the texture with the props set; the texture is set to the node
+		loader -:- decodes the image by background thread, the texture is placeholder until ready; None - blocking base.loader load
+		bake -:- blocking load of the baked texture (see TextureBake); the loader uses its own bake
+		'''
+		if loader is not None:
+			texture = loader.load(self)
+		else:
+			texture = base.loader.load_texture(self.path if bake is None else bake.get(self.path))
+		if np and ts:
+			np.set_texture(ts, texture)
+		elif np:
+			np.set_texture(texture)
+		self.set_texture_props(texture, np, ts)
+		return texture
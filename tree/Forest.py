@@ -0,0 +1,393 @@
+
+# python imports
+from typing import Iterable, Iterator, Optional, List, Tuple, NamedTuple, Set, Dict
+from concurrent.futures import ProcessPoolExecutor, Future, as_completed
+from multiprocessing import get_context, shared_memory
+import random
+
+# Panda3D imports
+from panda3d.core import Vec2, Vec3, Vec4, Point3, Quat, NodePath, LODNode, ColorScaleAttrib
+
+# other imports
+import numpy as np
+
+# Workbench imports
+from P3dTree import FractalTree, DefaultTree, InstancedLeaves
+from CollisionTubes import CollisionTubes
+from Stats import Stats
+from FrameScheduler import FrameScheduler
+
+
+class TreeBuffers(NamedTuple):
+	'''
+	Tree geometry generated by worker process and placed to shared memory block:
+	bodies of LOD levels - vertices (V3N3T2 rows) & triangles vertex indexes, leaves (position & direction quaternion rows),
+	collision tubes (see CollisionTubes)
+	'''
+	seed: int
+	shm_name: str
+	levels: Tuple[Tuple[int, int], ...] # vertices & indices count of every body
+	leaves_count: int
+	leaves_scale: float
+	scale: float
+	tubes_count: int = 0
+
+	def get_size(self) -> int:
+		return (sum(vertices_count * 8 + indices_count for vertices_count, indices_count in self.levels)
+			+ self.leaves_count * 7 + self.tubes_count * 7) * 4
+
+	def get_arrays(self, buffer) -> Tuple[List[Tuple[np.ndarray, np.ndarray]], np.ndarray, np.ndarray]:
+		'returns vertices & indices arrays of every body, leaves & collision tubes arrays placed at the buffer'
+		bodies, offset = [], 0
+		for vertices_count, indices_count in self.levels:
+			vertices = np.ndarray((vertices_count, 8), np.float32, buffer, offset)
+			offset += vertices.nbytes
+			indices = np.ndarray(indices_count, np.uint32, buffer, offset)
+			offset += indices.nbytes
+			bodies.append((vertices, indices))
+		leaves = np.ndarray((self.leaves_count, 7), np.float32, buffer, offset)
+		return bodies, leaves, np.ndarray((self.tubes_count, 7), np.float32, buffer, offset + leaves.nbytes)
+
+
+def build_tree_buffers(tree_class: type, seed: int, grow_steps: int, leaves_scale: Tuple[float, float],
+		lod_levels: Optional[Tuple[FractalTree.LODLevel, ...]] = None, collision = True,
+		collision_merge_level: Optional[int] = None) -> TreeBuffers:
+	'process pool worker: grows the tree, draws its bodies and places arrays to shared memory'
+	# growth updates the skeleton only: bodies are drawn once from the grown skeleton
+	t = tree_class(batch=True, seed=seed, load_assets=False, single_geom=True, collision_min_radius=None, deferred_meshing=True)
+	for _ in range(grow_steps):
+		t.grow()
+	if lod_levels:
+		bodies = []
+		for level in lod_levels:
+			bodies_np = NodePath('Bodies')
+			bodies_np.attach_new_node(t.make_lod_body(level))
+			bodies.append(t.get_body_arrays(bodies_np))
+	else:
+		t.finalize()
+		bodies = [t.get_body_arrays()]
+	leaves = np.concatenate(t.get_ends_arrays(), axis=1)
+	tubes = t.get_collision_tubes(merge_level=collision_merge_level) if collision else np.zeros((0, 7), np.float32)
+	buffers = TreeBuffers(seed, '', tuple((len(vertices), len(indices)) for vertices, indices in bodies), len(leaves),
+		t.random.uniform(*leaves_scale), t.get_scale().x, len(tubes))
+	shm = shared_memory.SharedMemory(create=True, size=max(buffers.get_size(), 1))
+	buffers = buffers._replace(shm_name=shm.name)
+	dst_bodies, dst_leaves, dst_tubes = buffers.get_arrays(shm.buf)
+	for (dst_vertices, dst_indices), (vertices, indices) in zip(dst_bodies, bodies):
+		dst_vertices[:], dst_indices[:] = vertices, indices
+	dst_leaves[:], dst_tubes[:] = leaves, tubes
+	del dst_bodies, dst_leaves, dst_tubes, dst_vertices, dst_indices # release shared memory buffer
+	shm.close()
+	return buffers
+
+
+class ForestBuilder:
+	'''
+	Generates trees at the process pool: skeleton growth & body vertex buffers are built by worker processes,
+	main process wraps shared memory buffers into GeomNodes.
+	Collision tubes of a generated tree are kept as FractalTree.COLLISION_TAG python tag of the tree node
+	and are placed to the forest by ForestGrid.
+	'''
+
+	COLLISION_MERGE_LEVEL = 2
+
+	def __init__(self, tree_class: type = DefaultTree, grow_steps = 10, leaves_scale: Tuple[float, float] = (.1, .15),
+			max_workers: Optional[int] = None, lod_levels: Optional[Tuple[FractalTree.LODLevel, ...]] = None,
+			impostor_distance: Optional[Tuple[float, float]] = FractalTree.IMPOSTOR_DISTANCE, instanced_leaves = False,
+			collision = True, collision_merge_level: Optional[int] = COLLISION_MERGE_LEVEL):
+		'''
+		lod_levels -:- make LOD trees with the levels (see FractalTree.get_lod); None - flattened trees
+		instanced_leaves -:- draw leaves of every tree by one instanced draw call
+		collision -:- generate collision tubes of the trees
+		collision_merge_level -:- subtrees of the level are merged to coarse capsules (see FractalTree.get_collision_tubes);
+			None - tube per branch
+		'''
+		self.tree_class, self.grow_steps, self.leaves_scale = tree_class, grow_steps, leaves_scale
+		self.lod_levels, self.impostor_distance = lod_levels, impostor_distance
+		self.instanced_leaves = instanced_leaves
+		self.collision, self.collision_merge_level = collision, collision_merge_level
+		self.pool = ProcessPoolExecutor(max_workers, get_context('spawn'))
+		self.futures: List[Future] = []
+		self.polled: Set[str] = set() # shared memory blocks of polled but not wrapped buffers
+
+	def submit(self, seeds: Iterable[int]) -> None:
+		'starts trees generation'
+		for seed in seeds:
+			self.futures.append(self.pool.submit(build_tree_buffers, self.tree_class, seed, self.grow_steps, self.leaves_scale,
+				self.lod_levels, self.collision, self.collision_merge_level))
+
+	def poll(self) -> List[NodePath]:
+		'returns generated trees; does not wait'
+		return [self.wrap(buffers) for buffers in self.poll_buffers()]
+
+	def poll_buffers(self) -> List[TreeBuffers]:
+		'''returns generated trees buffers; does not wait
+		Buffers should be wrapped by wrap() or iter_wrap()
+		'''
+		# every future is checked once: a future done between two checks would be in neither list
+		done, pending = [], []
+		for f in self.futures:
+			(done if f.done() else pending).append(f)
+		self.futures = pending
+		ret = [f.result() for f in done]
+		self.polled.update(buffers.shm_name for buffers in ret)
+		return ret
+
+	def build(self, seeds: Iterable[int]) -> Iterator[NodePath]:
+		'generates trees; yields trees as they are ready'
+		self.submit(seeds)
+		for f in as_completed(list(self.futures)):
+			self.futures.remove(f)
+			yield self.wrap(f.result())
+
+	@Stats.timed
+	def wrap(self, buffers: TreeBuffers) -> NodePath:
+		'makes flattened or LOD tree from generated buffers; frees shared memory'
+		return FrameScheduler.complete(self.iter_wrap(buffers))
+
+	def iter_wrap(self, buffers: TreeBuffers) -> Iterator[None]:
+		'resumable wrap(): yields after every body, leaves & LOD level (see FrameScheduler)'
+		shm, vertices, indices = shared_memory.SharedMemory(buffers.shm_name), None, None
+		try:
+			bodies, leaves, tubes = buffers.get_arrays(shm.buf)
+			tubes = tubes.copy() if self.collision else None
+			body_nodes = []
+			for vertices, indices in bodies:
+				body_nodes.append(FractalTree.make_body_node(vertices, indices))
+				yield
+			t: FractalTree = self.tree_class(seed=buffers.seed, instanced_leaves=self.instanced_leaves, collision_min_radius=None)
+			if t.instanced_leaves:
+				t.instanced_leaves.set_transforms(InstancedLeaves.get_matrices(leaves[:, :3], leaves[:, 3:], buffers.leaves_scale))
+			else:
+				for leaf in leaves.tolist():
+					t.draw_leaf(Vec3(*leaf[:3]), Quat(*leaf[3:]), buffers.leaves_scale)
+			bodies = leaves = vertices = indices = None # release shared memory buffer
+			self.polled.discard(buffers.shm_name)
+			shm.close()
+			shm.unlink()
+			shm = None
+			yield
+			t.set_scale(buffers.scale)
+			t.collision_np.remove_node()
+			if self.lod_levels:
+				ret = yield from t.iter_make_lod(zip(self.lod_levels, body_nodes), self.impostor_distance)
+			else:
+				t.bodies_np.attach_new_node(body_nodes[0])
+				ret = t.get_static()
+			if tubes is not None:
+				# tubes relative to the returned node: flattening applies the tree transform to vertices
+				ret.set_python_tag(FractalTree.COLLISION_TAG,
+					CollisionTubes.transform(tubes, ret.get_transform().invert_compose(t.get_transform()).get_mat()))
+			return ret
+		finally:
+			if shm is not None:
+				bodies = leaves = vertices = indices = None
+				self.polled.discard(buffers.shm_name)
+				shm.close()
+				shm.unlink()
+
+	def shutdown(self) -> None:
+		'''stops generation and frees generated but not wrapped trees
+		Not finished iter_wrap() jobs should be closed before
+		'''
+		for f in self.futures:
+			f.cancel()
+		self.pool.shutdown(cancel_futures=True)
+		shm_names = self.polled | {f.result().shm_name for f in self.futures if not f.cancelled() and f.exception() is None}
+		for shm_name in shm_names:
+			shm = shared_memory.SharedMemory(shm_name)
+			shm.close()
+			shm.unlink()
+		self.futures, self.polled = [], set()
+
+
+class ForestGrid:
+	'''
+	Forest split to square grid cells of the terrain. Trees of a cell are merged into one flattened batch
+	with one bounding volume, so cells out of view are culled as a whole.
+	LOD trees of a cell are merged level by level into one cell LODNode switched by distance to the cell center.
+	Adding or removing trees marks cells as changed; only changed cells are rebuilt.
+	Collision tubes of the trees of a cell (see ForestBuilder) are arranged to bounding volume hierarchy of the cell,
+	so collision queries test the cells & hierarchy nodes bounds first instead of every tree.
+	'''
+
+	def __init__(self, parent: NodePath, terrain_pos: Vec2, terrain_size: Vec3, cell_size = 64., merge = True,
+			collision_leaf_size: Optional[int] = 8):
+		'''
+		merge -:- merge trees of a cell to flattened batch; False - cell holds instances of trees sharing vertex data
+			(see TreePool), cells are still culled as a whole
+		collision_leaf_size -:- collision tubes per node of the cell collision hierarchy; None - no collision
+		'''
+		self.forest_np = parent.attach_new_node('Forest')
+		self.terrain_pos, self.terrain_size, self.cell_size = Vec2(terrain_pos), Vec3(terrain_size), cell_size
+		self.merge, self.collision_leaf_size = merge, collision_leaf_size
+		self.cells_trees: Dict[Tuple[int, int], Dict[int, NodePath]] = {} # placed trees of every cell by tree id
+		self.cells_np: Dict[Tuple[int, int], NodePath] = {} # cell batches
+		self.trees_cells: Dict[int, Tuple[int, int]] = {}
+		self.dirty: Set[Tuple[int, int]] = set()
+		self.next_id = 0
+
+	def __len__(self) -> int:
+		'returns trees count'
+		return len(self.trees_cells)
+
+	def get_cell(self, x: float, y: float) -> Tuple[int, int]:
+		'returns cell index of the terrain point'
+		return int((x - self.terrain_pos.x) // self.cell_size), int((y - self.terrain_pos.y) // self.cell_size)
+
+	def add(self, tree_np: NodePath, pos: Vec3, scale = 1., hpr: Optional[Vec3] = None,
+			tex_scale: Optional[Vec2] = None, tint: Optional[Vec4] = None) -> int:
+		'''places the tree; the tree node is instanced, so one tree can be placed many times
+		tex_scale -:- bark texture scale of the placed tree
+		tint -:- color scale of the placed tree
+		Returns id of the placed tree
+		'''
+		placed_np = NodePath('Tree')
+		tree_np.instance_to(placed_np)
+		placed_np.set_pos(pos)
+		placed_np.set_scale(scale)
+		if hpr is not None:
+			placed_np.set_hpr(hpr)
+		if tex_scale is not None and (bark_ts := tree_np.find_texture_stage(FractalTree.BARK_TEXTURE_STAGE)):
+			placed_np.set_tex_scale(bark_ts, tex_scale)
+		if tint is not None:
+			placed_np.set_color_scale(tint)
+		ret, self.next_id = self.next_id, self.next_id + 1
+		cell = self.get_cell(pos.x, pos.y)
+		self.cells_trees.setdefault(cell, {})[ret] = placed_np
+		self.trees_cells[ret] = cell
+		self.dirty.add(cell)
+		return ret
+
+	def remove(self, tree_id: int) -> None:
+		cell = self.trees_cells.pop(tree_id)
+		del self.cells_trees[cell][tree_id]
+		self.dirty.add(cell)
+
+	def rebuild(self) -> None:
+		'rebuilds changed cells'
+		FrameScheduler.complete(self.iter_rebuild())
+
+	def iter_rebuild(self) -> Iterator[None]:
+		'resumable rebuild(): yields after every changed cell (see FrameScheduler)'
+		while self.dirty:
+			self.build_cell(self.dirty.pop())
+			yield
+
+	@Stats.timed
+	def build_cell(self, cell: Tuple[int, int]) -> Optional[NodePath]:
+		'merges trees of the cell to the cell batch'
+		if (cell_np := self.cells_np.pop(cell, None)) is not None:
+			cell_np.remove_node()
+		if not (trees := self.cells_trees.get(cell)):
+			self.cells_trees.pop(cell, None)
+			return None
+		cell_np = self.cells_np[cell] = self.forest_np.attach_new_node(f'Cell {cell[0]} {cell[1]}')
+		if not self.merge:
+			for placed_np in trees.values():
+				placed_np.instance_to(cell_np)
+			self.add_cell_collision(cell_np, trees.values())
+			return cell_np
+		lod_trees: Dict[tuple, List[NodePath]] = {}
+		for placed_np in trees.values():
+			if (tree_np := placed_np.get_child(0)).node().is_of_type(LODNode):
+				lod = tree_np.node()
+				lod_trees.setdefault(tuple((lod.get_in(i), lod.get_out(i)) for i in range(lod.get_num_switches())), []).append(tree_np)
+			else:
+				placed_np.copy_to(cell_np)
+		self.merge_instanced_leaves(cell_np)
+		cell_np.flatten_strong()
+		# LOD trees with the same switches are merged level by level
+		center = Point3(self.terrain_pos.x + (cell[0] + .5) * self.cell_size, self.terrain_pos.y + (cell[1] + .5) * self.cell_size,
+			sum(placed_np.get_z() for placed_np in trees.values()) / len(trees))
+		for switches, lod_trees_nps in lod_trees.items():
+			lod = LODNode('Cell LOD')
+			lod.set_center(center)
+			lod_np = cell_np.attach_new_node(lod)
+			for i, (in_distance, out_distance) in enumerate(switches):
+				level_np = lod_np.attach_new_node(f'LOD {i}')
+				for tree_np in lod_trees_nps:
+					level_child_np = tree_np.get_child(i)
+					copy_np = level_child_np.copy_to(level_np)
+					copy_np.set_transform(level_child_np.get_net_transform())
+					copy_np.set_state(level_child_np.get_net_state())
+				self.merge_instanced_leaves(level_np)
+				level_np.flatten_strong()
+				lod.add_switch(in_distance, out_distance)
+		self.add_cell_collision(cell_np, trees.values())
+		if Stats.enabled:
+			Stats.count('forest cells built')
+		return cell_np
+
+	def add_cell_collision(self, cell_np: NodePath, placed_nps: Iterable[NodePath]) -> None:
+		'attaches collision hierarchy of tubes of the placed trees to the cell'
+		if self.collision_leaf_size is None:
+			return
+		tubes = [CollisionTubes.transform(tree_tubes, tree_np.get_net_transform().get_mat())
+			for placed_np in placed_nps
+			if (tree_tubes := (tree_np := placed_np.get_child(0)).get_python_tag(FractalTree.COLLISION_TAG)) is not None]
+		if tubes:
+			CollisionTubes.make_hierarchy(np.concatenate(tubes), self.collision_leaf_size).reparent_to(cell_np)
+
+	@staticmethod
+	def merge_instanced_leaves(parent_np: NodePath) -> None:
+		'''replaces instanced leaves nodes of the subgraph by one instanced leaves node drawn by one draw call
+		Color scale of every leaves node relative to the parent (for example tint of the placed tree) is kept as the leaves tints
+		'''
+		if len(leaves_nps := list(InstancedLeaves.find_all(parent_np))) < 2:
+			return
+		matrices, tints = [], []
+		for leaves_np in leaves_nps:
+			rows = InstancedLeaves.get_node_rows(leaves_np)
+			matrices.append(rows[:, :4] @ np.array(leaves_np.get_mat(parent_np), np.float32).reshape(4, 4))
+			color_scale = leaves_np.get_state(parent_np).get_attrib(ColorScaleAttrib)
+			tints.append(rows[:, 4] * (np.array(color_scale.get_scale(), np.float32) if color_scale and color_scale.has_scale() else 1))
+		merged_np = InstancedLeaves(leaves_nps[0].get_child(0))
+		merged_np.set_transforms(np.concatenate(matrices), np.concatenate(tints))
+		for leaves_np in leaves_nps:
+			leaves_np.remove_node()
+		merged_np.reparent_to(parent_np)
+
+
+class TreeVariation(NamedTuple):
+	'ranges of per-instance variation of the pool trees'
+	scale: Tuple[float, float] = (.25, 1)
+	heading: Tuple[float, float] = (0, 360)
+	tex_scale: Tuple[float, float] = (.5, 1.5) # bark texture scale
+	tint: Tuple[float, float] = (.8, 1.1) # color scale of every channel
+
+
+class TreePool:
+	'''
+	Pool of template trees generated once; forest trees are placed as instances of the templates
+	with per-instance variation of scale, heading, bark texture scale & tint.
+	Vertex data is shared by all instances of a template: memory depends on templates count, not on trees count.
+	'''
+
+	def __init__(self, builder: ForestBuilder, size = 10, variation = TreeVariation(), seed: Optional[int] = None):
+		'''
+		builder -:- generates the templates
+		size -:- templates count
+		'''
+		self.builder, self.size, self.variation = builder, size, variation
+		self.random = random.Random(seed)
+		self.templates: List[NodePath] = []
+
+	def is_ready(self) -> bool:
+		return len(self.templates) >= self.size
+
+	def submit(self) -> None:
+		'starts templates generation; generated templates should be appended to templates'
+		self.builder.submit(self.random.getrandbits(64) for _ in range(self.size - len(self.templates)))
+
+	def build(self) -> None:
+		'generates templates; waits'
+		self.templates.extend(self.builder.build(self.random.getrandbits(64) for _ in range(self.size - len(self.templates))))
+
+	def place(self, grid: ForestGrid, pos: Vec3) -> int:
+		'''places instance of random template with random variation to the grid
+		Returns id of the placed tree
+		'''
+		r, v = self.random, self.variation
+		return grid.add(r.choice(self.templates), pos, r.uniform(*v.scale), Vec3(r.uniform(*v.heading), 0, 0),
+			Vec2(r.uniform(*v.tex_scale), r.uniform(*v.tex_scale)), Vec4(*(r.uniform(*v.tint) for _ in range(3)), 1))
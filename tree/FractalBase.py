@@ -1,11 +1,24 @@
 
 # python imports
-from typing import Iterable, Iterator, Optional, List, Tuple, NamedTuple
+from typing import Iterable, Iterator, Optional, List, Tuple, NamedTuple, Sequence, Dict
+import mmap
+import os
 import random
+import struct
+from os import path
+from sys import path as search_paths
 
 # Panda3D imports
 from panda3d.core import Vec3, Quat
 
+# other imports
+import numpy as np
+
+# Workbench imports
+module_path = path.dirname(path.abspath(__file__))
+search_paths.insert(0, path.abspath(path.join(module_path, '../lib')))
+from Stats import Stats
+
 
 class FractalBase:
 	'''
@@ -39,11 +52,270 @@ class FractalBase:
 			self.branches.append(ret)
 			return ret
 
-	def __init__(self, root: BranchProps):
+	class BranchStore:
+		'''
+		Structure-of-arrays storage of the branch hierarchy: one row per branch.
+		Children of a branch are stored in successive rows, the parent row refers to the first child.
+
+		Skeleton file (see save & load) is the header followed by the used rows of every array in ARRAYS order
+		and the ends rows; arrays are fixed-width little-endian, so the file is mapped to memory as is.
+		'''
+
+		ARRAYS = ('pos', 'quat', 'length', 'radius', 'total_length', 'parent', 'depth', 'first_child', 'children_count')
+		FILE_HEADER = struct.Struct('<4sIIIf') # magic, format version, rows count, ends count, scale of the figure
+		FILE_MAGIC = b'FBSK'
+		FILE_VERSION = 1
+
+		def __init__(self, capacity: int = 256):
+			self.size = 0
+			self.pos = np.zeros((capacity, 3), np.float32)
+			self.quat = np.zeros((capacity, 4), np.float32) # Quat components order: r, i, j, k
+			self.length = np.zeros(capacity, np.float32)
+			self.radius = np.zeros(capacity, np.float32)
+			self.total_length = np.zeros(capacity, np.float32)
+			self.parent = np.full(capacity, -1, np.int32)
+			self.depth = np.zeros(capacity, np.int32) # same as BranchProps.branches_count
+			self.first_child = np.full(capacity, -1, np.int32)
+			self.children_count = np.zeros(capacity, np.int32)
+			self.ends = np.zeros(0, np.int32) # rows of branches without children
+
+		def __len__(self) -> int:
+			return self.size
+
+		def reserve(self, capacity: int) -> None:
+			'''grows arrays to hold at least capacity rows
+			Read-only arrays (for example mapped skeleton file, see load) are copied
+			'''
+			if capacity <= len(self.length) and self.length.flags.writeable:
+				return
+			capacity = max(capacity, len(self.length) * 2)
+			for name in self.ARRAYS:
+				old = getattr(self, name)
+				new = np.full((capacity, ) + old.shape[1:], -1 if name in ('parent', 'first_child') else 0, old.dtype)
+				new[:self.size] = old[:self.size]
+				setattr(self, name, new)
+
+		def add_root(self, root: 'FractalBase.BranchProps') -> int:
+			'adds the root branch with all its children branches'
+			self.size = 0
+			queue = [(root, self.add(-1, (root.pos, ), (tuple(root.direction), ), (root.length, ), (root.radius, ),
+				(root.total_length, ), root.branches_count).start)]
+			for props, index in queue: # breadth-first to keep children in successive rows
+				if props.branches:
+					rows = self.add(index, [b.pos for b in props.branches], [tuple(b.direction) for b in props.branches],
+						[b.length for b in props.branches], [b.radius for b in props.branches],
+						[b.total_length for b in props.branches], [b.branches_count for b in props.branches])
+					queue.extend(zip(props.branches, rows))
+			self.ends = np.flatnonzero(self.children_count[:self.size] == 0).astype(np.int32)
+			return 0
+
+		def add(self, parent: int, pos, quat, length, radius, total_length, depth) -> range:
+			'''appends branches in bulk
+			Returns rows of the added branches
+			'''
+			count = len(length)
+			start = self.size
+			if not count:
+				return range(start, start)
+			self.reserve(start + count)
+			end = start + count
+			self.pos[start:end] = pos
+			self.quat[start:end] = quat
+			self.length[start:end] = length
+			self.radius[start:end] = radius
+			self.total_length[start:end] = total_length
+			self.parent[start:end] = parent
+			self.depth[start:end] = depth
+			if np.ndim(parent) == 0:
+				if parent >= 0 and count:
+					self.first_child[parent], self.children_count[parent] = start, count
+			elif count:
+				# children of the same parent should be successive
+				parents, first, counts = np.unique(parent, return_index=True, return_counts=True)
+				self.first_child[parents], self.children_count[parents] = first + start, counts
+			self.size = end
+			return range(start, end)
+
+		def get_arrays(self) -> Dict[str, np.ndarray]:
+			'returns used rows of the arrays & ends rows'
+			ret = {name: getattr(self, name)[:self.size] for name in self.ARRAYS}
+			ret['ends'] = self.ends
+			return ret
+
+		@classmethod
+		def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> 'FractalBase.BranchStore':
+			'makes the store from arrays returned by get_arrays()'
+			ret = cls(0)
+			ret.size = len(arrays['length'])
+			for name in cls.ARRAYS + ('ends', ):
+				setattr(ret, name, np.array(arrays[name], getattr(ret, name).dtype))
+			return ret
+
+		def save(self, file_path: str, scale = 1.) -> None:
+			'''writes the skeleton file
+			scale -:- scale of the figure node (see FractalTree.grow)
+			'''
+			# write to temporary file first: interrupted write should not leave broken file
+			with open(f'{file_path}.tmp', 'wb') as f:
+				f.write(self.FILE_HEADER.pack(self.FILE_MAGIC, self.FILE_VERSION, self.size, len(self.ends), scale))
+				for name, array in self.get_arrays().items():
+					f.write(np.ascontiguousarray(array, array.dtype.newbyteorder('<')).data)
+			os.replace(f'{file_path}.tmp', file_path)
+
+		@classmethod
+		def load(cls, file_path: str) -> Tuple['FractalBase.BranchStore', float]:
+			'''maps the skeleton file to memory; returns the store & scale of the figure
+			Arrays of the store are read-only views of the mapped file: pages are read on demand and shared by processes
+			mapping the same file. Growth of the store copies the arrays (see reserve).
+			'''
+			with open(file_path, 'rb') as f:
+				buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			magic, version, size, ends_count, scale = cls.FILE_HEADER.unpack_from(buffer)
+			if magic != cls.FILE_MAGIC or version != cls.FILE_VERSION:
+				raise ValueError(f'{file_path} is not a skeleton file of version {cls.FILE_VERSION}')
+			ret, offset = cls(0), cls.FILE_HEADER.size
+			for name in cls.ARRAYS + ('ends', ):
+				template = getattr(ret, name)
+				shape = (ends_count if name == 'ends' else size, ) + template.shape[1:]
+				array = np.frombuffer(buffer, template.dtype.newbyteorder('<'), int(np.prod(shape)), offset).reshape(shape)
+				setattr(ret, name, array)
+				offset += array.nbytes
+			ret.size = size
+			return ret, scale
+
+		def children(self, index: int) -> range:
+			first = self.first_child[index]
+			return range(first, first + self.children_count[index]) if first >= 0 else range(0)
+
+		def get_props(self, index: int, depth: Optional[int] = 1) -> 'FractalBase.BranchProps':
+			'''returns BranchProps view of the branch
+			depth -:- levels of children branches to include to the view; None - whole subtree
+			'''
+			return FractalBase.BranchProps(
+				Vec3(*self.pos[index]), Quat(*self.quat[index]), float(self.length[index]), float(self.radius[index]),
+				[self.get_props(i, None if depth is None else depth - 1) for i in self.children(index)]
+					if depth is None or depth > 0 else [],
+				float(self.total_length[index]), int(self.depth[index])
+			)
+
+		def get_props_list(self, rows: Sequence[int], children = True) -> List['FractalBase.BranchProps']:
+			'''returns BranchProps views of the branches, same as get_props(index, 1 if children else 0) of every row
+			Rows of the branches & their children are read by one bulk read, indexing arrays by a row is slow
+			'''
+			rows = np.asarray(rows, np.int64).reshape(-1)
+			counts = self.children_count[rows] if children else np.zeros(len(rows), np.int32)
+			# children rows of every branch are successive
+			starts = np.repeat(self.first_child[rows] - np.cumsum(counts) + counts, counts)
+			all_rows = np.concatenate((rows, starts + np.arange(len(starts))))
+			ret = [FractalBase.BranchProps(Vec3(*pos), Quat(*quat), length, radius, [], total_length, depth)
+				for pos, quat, length, radius, total_length, depth in zip(self.pos[all_rows].tolist(), self.quat[all_rows].tolist(),
+					self.length[all_rows].tolist(), self.radius[all_rows].tolist(), self.total_length[all_rows].tolist(),
+					self.depth[all_rows].tolist())]
+			child = len(rows)
+			for props, count in zip(ret, counts.tolist()):
+				props.branches.extend(ret[child:child + count])
+				child += count
+			return ret[:len(rows)]
+
+		def next_pos(self, rows: np.ndarray) -> np.ndarray:
+			'returns end positions of the branches: pos + direction.xform(Vec3(0, 0, length))'
+			r, i, j, k = self.quat[rows].T
+			up = np.stack((2 * (i * k + r * j), 2 * (j * k - r * i), 1 - 2 * (i * i + j * j)), axis=-1)
+			return self.pos[rows] + up * self.length[rows, None]
+
+		@staticmethod
+		def quat_from_hpr(hpr: np.ndarray) -> np.ndarray:
+			'vectorized Quat.set_hpr for array of HPR angles in degrees; Z-up right handed coordinate system'
+			s, c = np.sin(np.radians(hpr) / 2).T, np.cos(np.radians(hpr) / 2).T
+			zero = np.zeros_like(s[0])
+			quat_h = np.stack((c[0], zero, zero, s[0]), axis=-1) # about up axis
+			quat_p = np.stack((c[1], s[1], zero, zero), axis=-1) # about right axis
+			quat_r = np.stack((c[2], zero, s[2], zero), axis=-1) # about forward axis
+			return FractalBase.BranchStore.quat_mul(FractalBase.BranchStore.quat_mul(quat_r, quat_p), quat_h)
+
+		@staticmethod
+		def quat_mul(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+			'vectorized Panda3D Quat product a * b: rotation a then rotation b'
+			ar, ai, aj, ak = np.moveaxis(a, -1, 0)
+			br, bi, bj, bk = np.moveaxis(b, -1, 0)
+			return np.stack((
+				br * ar - bi * ai - bj * aj - bk * ak,
+				bi * ar + br * ai - bk * aj + bj * ak,
+				bj * ar + bk * ai + br * aj - bi * ak,
+				bk * ar - bj * ai + bi * aj + br * ak,
+			), axis=-1)
+
+	def __init__(self, root: BranchProps, use_store = False, batch = False, seed: Optional[int] = None,
+			rng: Optional[random.Random] = None):
+		'''
+		use_store -:- keep branches at BranchStore arrays instead of nested BranchProps; per-branch callbacks
+			are still called for every end, so growth is not faster than nested branches (see batch)
+		batch -:- grow all ends of the branch store by one vectorized pass; implies use_store
+		seed -:- seed of the tree random streams; the same seed gives the same tree; None - take from rng
+		rng -:- random stream to take the seed from; None - global random module
+		'''
 		self.branch_min_radius = .01
 		self.branch_min_len, self.next_branch_radius_k = .2, (.3, .9)
-		self.root = root
+		self.store: Optional[FractalBase.BranchStore] = None
+		self.seed: int = (rng or random).getrandbits(64) if seed is None else seed
+		self.random = random.Random(self.seed) # all split/length/angle/radius decisions
+		self.batch = batch
+		self.batch_random = np.random.default_rng(self.seed) if batch else None
+		if use_store or batch:
+			self.store = self.BranchStore()
+			self.store.add_root(root)
+		self._root = root
 		self.ends: List[self.BranchProps] = []
+		# ends diff of the last grow step: BranchProps or branch store rows
+		self.added_ends: Sequence = []
+		self.retired_ends: Sequence = []
+
+	@property
+	def root(self) -> BranchProps:
+		'root branch; for branch store it is BranchProps view of the whole tree'
+		return self._root if self.store is None else self.store.get_props(0, None)
+
+	def set_store(self, store: 'FractalBase.BranchStore') -> None:
+		'''replaces branches by the store (for example loaded skeleton, see BranchStore.load)
+		Ends of the store are the added ends, previous ends are the retired ends
+		'''
+		self.retired_ends = self.store.ends if self.store is not None else list(self.iter_ends(self._root))
+		self.store, self.added_ends = store, store.ends
+
+	def get_branch_store(self) -> 'FractalBase.BranchStore':
+		'returns the branch store; for nested branches makes the store from the root'
+		if self.store is not None:
+			return self.store
+		store = self.BranchStore()
+		store.add_root(self._root)
+		return store
+
+	def iter_tree_ends(self) -> Iterator[BranchProps]:
+		'iterates branches without children'
+		if self.store is None:
+			yield from self.iter_ends(self._root)
+		else:
+			yield from self.store.get_props_list(self.store.ends, False)
+
+	def get_ends_arrays(self) -> Tuple[np.ndarray, np.ndarray]:
+		'returns positions (n, 3) & Quat directions (n, 4) of branches without children'
+		if self.store is None:
+			ends = list(self.iter_ends(self._root))
+			return (np.array([tuple(branch.pos) for branch in ends], np.float32).reshape(-1, 3),
+				np.array([tuple(branch.direction) for branch in ends], np.float32).reshape(-1, 4))
+		return self.store.pos[self.store.ends], self.store.quat[self.store.ends]
+
+	def iter_branches(self) -> Iterator[BranchProps]:
+		'iterates branches having children branches'
+		if self.store is None:
+			stack = [self._root]
+			while stack:
+				branch = stack.pop()
+				if branch.branches:
+					yield branch
+					stack.extend(reversed(branch.branches))
+		else:
+			yield from self.store.get_props_list(np.flatnonzero(self.store.children_count[:len(self.store)]))
 
 	@classmethod
 	def iter_ends(cls, root: BranchProps) -> Iterator[BranchProps]:
@@ -55,56 +327,155 @@ class FractalBase:
 			for branch_ in root.branches:
 				yield from cls.iter_ends(branch_)
 
-	def get_next_ends(self) -> List[BranchProps]:
-		'generate next grow-step parameters'
-
-		def generate_next_branches(branch: self.BranchProps) -> Iterable[self.BranchProps]:
-			'returns branches that has grown children branches'
-			ret = []
-			if (branches_count := self.get_next_branches_count(branch)):
-				# print(f'get_next_branches_count: {branches_count}')
-				# add branches # generate branches
-				if branches_count == 1:
-					# just continue branch # add one branch
-					next_len = branch.length * random.uniform(.9, 1.05)
-					q = Quat()
-					q.set_hpr(Vec3(0, random.uniform(-180 / 5, 180 / 5), random.uniform(-180 / 5, 180 / 5)))
-					next_direction = q * branch.direction
-					branch.add_branch(next_direction, next_len, branch.radius)
-				else:
-					# add multiple branches # generate radiuses & directions
-					next_radiuses = [ next_radius for next_radius in
-						(self.next_branch_radius(branch) for _ in range(branches_count))
-						if next_radius >= self.branch_min_radius
-					]
-					next_directions = list(map(Quat, (0,) * len(next_radiuses)))
-					for q in next_directions:
-						q.set_hpr(Vec3(0, random.uniform(-180 / 4, 180 / 4), random.uniform(-180 / 4, 180 / 4)))
-						q = branch.direction * q
-					next_lens = []
-					for _ in range(len(next_radiuses)):
-						next_lens.append(branch.length * random.uniform(.2, 1.5))
-					# print(f'get_next_branches_count: {next_radiuses=} {next_directions=} {next_lens=}')
-					# add branches
-					for next_radius, next_direction, next_len in zip(next_radiuses, next_directions, next_lens):
-						# add branch
-						branch.add_branch(next_direction, next_len, next_radius)
-				ret.append(branch)
-			else:
-				# print(f'get_next_branches_count: 0')
-				pass
-			return ret
+	def generate_next_branches(self, branch: BranchProps) -> Optional[List[Tuple[Quat, float, float]]]:
+		'''generates children branches parameters: direction, length, radius
+		Returns None if branch stops grow
+		'''
+		if not (branches_count := self.get_next_branches_count(branch)):
+			return None
+		# print(f'get_next_branches_count: {branches_count}')
+		# add branches # generate branches
+		if branches_count == 1:
+			# just continue branch # add one branch
+			next_len = branch.length * self.random.uniform(.9, 1.05)
+			q = Quat()
+			q.set_hpr(Vec3(0, self.random.uniform(-180 / 5, 180 / 5), self.random.uniform(-180 / 5, 180 / 5)))
+			next_direction = q * branch.direction
+			return [(next_direction, next_len, branch.radius)]
+		# add multiple branches # generate radiuses & directions
+		next_radiuses = [ next_radius for next_radius in
+			(self.next_branch_radius(branch) for _ in range(branches_count))
+			if next_radius >= self.branch_min_radius
+		]
+		next_directions = list(map(Quat, (0,) * len(next_radiuses)))
+		for q in next_directions:
+			q.set_hpr(Vec3(0, self.random.uniform(-180 / 4, 180 / 4), self.random.uniform(-180 / 4, 180 / 4)))
+			q = branch.direction * q
+		next_lens = []
+		for _ in range(len(next_radiuses)):
+			next_lens.append(branch.length * self.random.uniform(.2, 1.5))
+		# print(f'get_next_branches_count: {next_radiuses=} {next_directions=} {next_lens=}')
+		return list((next_direction, next_len, next_radius)
+			for next_radius, next_direction, next_len in zip(next_radiuses, next_directions, next_lens))
+
+	def get_next_ends(self) -> Sequence:
+		'''generate next grow-step parameters
+		Returns grown branches: BranchProps of nested branches or rows of branch store (see get_branches_props)
+		'''
+		if self.store is not None:
+			if self.batch and self.is_batch_compatible():
+				return self.get_next_batch_ends()
+			return self.get_next_store_ends()
 
-		ret = []
-		for branch in self.iter_ends(self.root):
-			ret += generate_next_branches(branch)
+		ret, added, retired = [], [], []
+		for branch in self.iter_ends(self._root):
+			if (next_branches := self.generate_next_branches(branch)) is not None:
+				for next_direction, next_len, next_radius in next_branches:
+					# add branch
+					added.append(branch.add_branch(next_direction, next_len, next_radius))
+				if next_branches:
+					retired.append(branch)
+				ret.append(branch)
+		self.added_ends, self.retired_ends = added, retired
 		return ret
 
-	def grow(self) -> Iterable[BranchProps]:
+	def get_next_store_ends(self) -> np.ndarray:
+		'''generate next grow-step parameters at branch store; returns rows of grown branches
+		The per-branch callbacks get BranchProps made from the ends rows; only batch growth (see get_next_batch_ends)
+		is vectorized, this path costs about the same as nested branches
+		'''
+		store, ends = self.store, self.store.ends
+		grown, counts, children = [], [], []
+		generate_next_branches, BranchProps = self.generate_next_branches, self.BranchProps
+		# branches of all ends are generated first & added by one bulk add; the ends rows are taken at once,
+		# indexing arrays by a row is slow
+		for index, pos_, quat_, length_, radius_, total_length_, depth_ in zip(ends.tolist(), store.pos[ends].tolist(),
+				store.quat[ends].tolist(), store.length[ends].tolist(), store.radius[ends].tolist(),
+				store.total_length[ends].tolist(), store.depth[ends].tolist()):
+			if (next_branches := generate_next_branches(
+					BranchProps(Vec3(*pos_), Quat(*quat_), length_, radius_, [], total_length_, depth_))) is None:
+				counts.append(0)
+				continue
+			grown.append(index)
+			counts.append(len(next_branches))
+			children.extend(next_branches)
+		quat = [tuple(next_direction) for next_direction, _, _ in children]
+		length = [next_len for _, next_len, _ in children]
+		radius = [next_radius for _, _, next_radius in children]
+		# add branches
+		counts = np.array(counts, np.int32)
+		parents = np.repeat(ends, counts)
+		rows = store.add(parents, store.next_pos(parents), np.array(quat, np.float32).reshape(-1, 4), length, radius,
+			store.total_length[parents] + store.length[parents], store.depth[parents] + 1)
+		# replace grown ends by children branches
+		next_ends = np.repeat(ends, np.maximum(counts, 1))
+		next_ends[np.repeat(counts > 0, np.maximum(counts, 1))] = np.arange(rows.start, rows.stop)
+		store.ends = next_ends
+		self.added_ends = np.arange(rows.start, rows.stop, dtype=np.int32)
+		self.retired_ends = ends[counts > 0]
+		return np.array(grown, np.int32)
+
+	def get_next_batch_ends(self) -> np.ndarray:
+		'generate next grow-step parameters for all ends of branch store at once; returns rows of grown branches'
+		store, ends, rng = self.store, self.store.ends, self.batch_random
+		counts = self.get_next_branches_counts(ends)
+		grown = ends[counts > 0]
+		# one row per generated child branch
+		parents = np.repeat(ends, counts)
+		single = np.repeat(counts == 1, counts) # just continue branch
+		radius = store.radius[parents]
+		radius[~single] = self.next_branch_radii(parents[~single])
+		keep = single | (radius >= self.branch_min_radius)
+		parents, single, radius = parents[keep], single[keep], radius[keep]
+		# generate directions & lengths
+		angle_limit = np.where(single, 180 / 5, 180 / 4)
+		hpr = np.zeros((len(parents), 3))
+		hpr[:, 1:] = rng.uniform(-1, 1, (len(parents), 2)) * angle_limit[:, None]
+		direction = store.quat_from_hpr(hpr)
+		direction[single] = store.quat_mul(direction[single], store.quat[parents[single]])
+		length = store.length[parents] * rng.uniform(np.where(single, .9, .2), np.where(single, 1.05, 1.5))
+		# add branches
+		rows = store.add(parents, store.next_pos(parents), direction, length, radius,
+			store.total_length[parents] + store.length[parents], store.depth[parents] + 1)
+		# replace grown ends by children branches
+		children_count = store.children_count[ends] if len(rows) else np.zeros(len(ends), np.int32)
+		next_ends = np.repeat(ends, np.maximum(children_count, 1))
+		next_ends[np.repeat(children_count > 0, np.maximum(children_count, 1))] = np.arange(rows.start, rows.stop)
+		store.ends = next_ends
+		self.added_ends = np.arange(rows.start, rows.stop, dtype=np.int32)
+		self.retired_ends = ends[children_count > 0]
+		return grown
+
+	def is_batch_compatible(self) -> bool:
+		'''checks that per-branch callbacks overridden by subclass have batched versions
+		Otherwise the slower per-branch growth is used
+		'''
+		cls = type(self)
+		return all(getattr(cls, batched) is not getattr(FractalBase, batched) or getattr(cls, per_branch) is getattr(FractalBase, per_branch)
+			for per_branch, batched in (
+				('get_next_branches_count', 'get_next_branches_counts'),
+				('next_branch_radius', 'next_branch_radii'),
+				('generate_next_branches', 'get_next_batch_ends'),
+			))
+
+	@Stats.timed
+	def grow(self, props = True) -> Sequence:
 		'''grows the tree
-		Returns list of branches that has grown children branches
+		Returns list of branches that has grown children branches;
+		ends diff of the step is kept at added_ends & retired_ends
+		props -:- False - branch store rows of grown branches are returned without making BranchProps views
 		'''
-		return self.get_next_ends()
+		ret = self.get_next_ends()
+		if Stats.enabled:
+			Stats.count('branches', len(self.added_ends))
+			Stats.level('ends', len(self.store.ends) if self.store is not None else sum(1 for _ in self.iter_ends(self._root)))
+		return self.get_branches_props(ret) if props else ret
+
+	def get_branches_props(self, branches: Sequence) -> List[BranchProps]:
+		'returns BranchProps of branches returned by get_next_ends(): BranchProps or branch store rows'
+		if self.store is None or not isinstance(branches, np.ndarray):
+			return list(branches)
+		return self.store.get_props_list(branches)
 
 	# parameterized branch split callbacks
 
@@ -112,20 +483,30 @@ class FractalBase:
 		if branch.length < self.branch_min_len:
 			# stop grow this branch
 			return 0
-		if random.random() >= .7:
+		if self.random.random() >= .7:
 			# split to multiple branchs
 			return 2
 		# continue one branch
 		return 1
 
 	def next_branch_radius(self, branch: BranchProps) -> float:
-		return branch.radius * random.uniform(.3, .9)
+		return branch.radius * self.random.uniform(.3, .9)
+
+	# batched branch split callbacks: rows of branch store
+
+	def get_next_branches_counts(self, rows: np.ndarray) -> np.ndarray:
+		counts = np.where(self.batch_random.random(len(rows)) >= .7, 2, 1)
+		counts[self.store.length[rows] < self.branch_min_len] = 0 # stop grow this branches
+		return counts
+
+	def next_branch_radii(self, rows: np.ndarray) -> np.ndarray:
+		return self.store.radius[rows] * self.batch_random.uniform(.3, .9, len(rows))
 
 
 if __name__ == "__main__":
 	q = Quat()
 	q.setHpr(Vec3(0, 0, 0))
-	f = FractalBase(FractalBase.BranchProps(Vec3(0, 0, 0), q, 1, .1, []))
+	f = FractalBase(FractalBase.BranchProps(Vec3(0, 0, 0), q, 1, .1, []), seed=1)
 	f.grow()
 	f.grow()
 	f.grow()
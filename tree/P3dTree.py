@@ -33,24 +33,111 @@ OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 '''
 
 # python imports
-from typing import Iterable, Iterator, Optional, List, Tuple, NamedTuple, Callable
+from typing import Iterable, Iterator, Optional, List, Tuple, NamedTuple, Callable, Dict, Set, Sequence
 import math
 import random
+import weakref
 from os import path
 from sys import path as search_paths
 
 # Panda3D imports
 from panda3d.core import (Mat4, Vec2, Vec3, Vec4, Point3, Quat, Geom, GeomNode, Texture, TextureStage,
-	GeomVertexWriter, GeomTristrips, GeomVertexRewriter, GeomVertexData, GeomVertexFormat,
-	CollisionNode, CollisionTube, TransformState, NodePath, PNMImage, ShaderTerrainMesh, Shader, AmbientLight,
-	TextNode, WindowProperties, PandaSystem)
+	GeomTristrips, GeomTriangles, GeomVertexData, GeomVertexFormat,
+	CollisionTube, TransformState, NodePath, ShaderTerrainMesh, Shader, AmbientLight,
+	TextNode, WindowProperties, PandaSystem, LODNode, CardMaker, Camera, OrthographicLens, TransparencyAttrib,
+	FrameBufferProperties, GraphicsPipe, GraphicsOutput, ModelNode, BoundingBox, CallbackNode, PythonCallbackObject)
 from direct.gui.OnscreenText import OnscreenText
 
+# other imports
+import numpy as np
+
 # Workbench imports
 from FractalBase import FractalBase
 module_path = path.dirname(path.abspath(__file__))
 search_paths.insert(0, path.abspath(path.join(module_path, '../lib')))
 from TextureProps import TextureProps
+from TextureLoader import TextureLoader
+from RingMesh import RingMesh
+from Stats import Stats
+from FrameScheduler import FrameScheduler
+from InstanceBuffer import InstanceBuffer
+from Heightfield import Heightfield, TerrainNoise
+from CollisionTubes import CollisionTubes
+
+
+class InstancedLeaves(NodePath):
+	'''
+	Leaves drawn by one instanced draw call: transforms & tints of all leaves are packed to buffer texture (see InstanceBuffer)
+	and applied by the shader. Transforms are relative to the node; flattening does not touch the node.
+	Tint is the color scale of the leaf (for example of the placed tree the leaves are merged from, see ForestGrid).
+	'''
+
+	SHADER_PATHS = ('leaves/leaves.vert.glsl', 'leaves/leaves.frag.glsl')
+	TAG = 'instanced_leaves'
+
+	def __init__(self, leaf_np: Optional[NodePath], name = 'Instanced Leaves', node_np: Optional[NodePath] = None):
+		'''
+		node_np -:- existing instanced leaves node to wrap (for example loaded from .bam file); leaf_np is ignored
+		'''
+		if node_np is not None:
+			super().__init__(node_np)
+			self.leaf_bounds = self.get_child(0).get_bounds()
+		else:
+			super().__init__(ModelNode(name))
+			self.node().set_preserve_transform(ModelNode.PT_no_touch)
+			self.set_tag(self.TAG, '')
+			leaf_np.copy_to(self)
+			self.leaf_bounds = leaf_np.get_bounds()
+		self.transforms = Texture('leaf transforms')
+		self.matrices, self.tints = np.zeros((0, 4, 4), np.float32), np.zeros((0, 4), np.float32)
+		self.set_shader(Shader.load(Shader.SL_GLSL, vertex=self.SHADER_PATHS[0], fragment=self.SHADER_PATHS[1]))
+		self.set_shader_input('leaf_transforms', self.transforms)
+		self.set_transforms(self.matrices)
+
+	@staticmethod
+	def get_node_rows(leaves_np: NodePath) -> np.ndarray:
+		'returns texels (n, 5, 4) of instanced leaves node (for example copied by flattening): matrix rows & tint'
+		return InstanceBuffer.get_rows(leaves_np.get_shader_input('leaf_transforms').get_texture(), leaves_np.get_instance_count(), 5)
+
+	@classmethod
+	def get_node_matrices(cls, leaves_np: NodePath) -> np.ndarray:
+		'returns leaves matrices (n, 4, 4) of instanced leaves node'
+		return cls.get_node_rows(leaves_np)[:, :4]
+
+	@classmethod
+	def get_node_tints(cls, leaves_np: NodePath) -> np.ndarray:
+		'returns leaves tints (n, 4) of instanced leaves node'
+		return cls.get_node_rows(leaves_np)[:, 4]
+
+	@classmethod
+	def find_all(cls, parent_np: NodePath) -> Iterator[NodePath]:
+		'iterates instanced leaves nodes of the subgraph'
+		yield from parent_np.find_all_matches('**/=' + cls.TAG)
+
+	@staticmethod
+	def get_matrices(pos: np.ndarray, quat: np.ndarray, scale: float) -> np.ndarray:
+		'''returns leaves matrices: Mat4.scale_mat(scale) * quat matrix * Mat4.translate_mat(pos)
+		pos, quat -:- (n, 3) positions & (n, 4) Quat directions of leaves
+		'''
+		r, i, j, k = np.asarray(quat, np.float32).T
+		ret = np.zeros((len(r), 4, 4), np.float32)
+		# rotation matrix for row vectors
+		ret[:, 0, :3] = np.stack((1 - 2 * (j * j + k * k), 2 * (i * j + k * r), 2 * (i * k - j * r)), axis=-1)
+		ret[:, 1, :3] = np.stack((2 * (i * j - k * r), 1 - 2 * (i * i + k * k), 2 * (j * k + i * r)), axis=-1)
+		ret[:, 2, :3] = np.stack((2 * (i * k + j * r), 2 * (j * k - i * r), 1 - 2 * (i * i + j * j)), axis=-1)
+		ret[:, :3, :3] *= scale
+		ret[:, 3, :3] = pos
+		ret[:, 3, 3] = 1
+		return ret
+
+	def set_transforms(self, matrices: np.ndarray, tints: Optional[np.ndarray] = None) -> None:
+		'''replaces leaves by the matrices (n, 4, 4)
+		tints -:- (n, 4) color scales of the leaves; None - not tinted
+		'''
+		self.matrices = np.ascontiguousarray(matrices, np.float32)
+		self.tints = np.ones((len(self.matrices), 4), np.float32) if tints is None else np.asarray(tints, np.float32).reshape(-1, 4)
+		# tint at the texel following the matrix
+		InstanceBuffer.set_instances(self, self.transforms, self.matrices, self.leaf_bounds, self.tints[:, None, :])
 
 
 class FractalTree(NodePath, FractalBase):
@@ -58,30 +145,328 @@ class FractalTree(NodePath, FractalBase):
 	Base class for fractal trees
 	'''
 
-	def __init__(self, bark_texture, leaf_np, root: FractalBase.BranchProps):
+	class LODLevel(NamedTuple):
+		near: float # switch distances
+		far: float
+		num_side_slices: int
+		min_radius: float # thinner branches are dropped
+
+	LOD_LEVELS = (LODLevel(0, 80, 12, 0), LODLevel(80, 250, 6, .1), LODLevel(250, 600, 3, .3))
+	IMPOSTOR_DISTANCE = (600, 3000) # near, far distances of billboard card
+	BARK_TEXTURE_STAGE = 'bark_ts'
+	COLLISION_MIN_RADIUS = .1 # thinner branches have no collision tubes
+	COLLISION_TAG = 'collision_tubes' # python tag of collision tubes array of the tree node without collision nodes (LOD tree)
+
+	def __init__(self, bark_texture, leaf_np, root: FractalBase.BranchProps, use_store = False, batch = False,
+			seed: Optional[int] = None, rng: Optional[random.Random] = None, single_geom = False, instanced_leaves = False,
+			collision_min_radius: Optional[float] = COLLISION_MIN_RADIUS, deferred_meshing = False):
+		'''
+		single_geom -:- draw all branches to one Geom instead of GeomNode per branch segment
+		instanced_leaves -:- draw leaves by one instanced draw call instead of node per leaf
+		collision_min_radius -:- drawn branches not thinner than it get collision tubes; None - no collision tubes
+		deferred_meshing -:- grow() updates the skeleton only; branches grown since the last meshing & leaves
+			are meshed by one bulk pass when the tree is first in view, flattened or finalized (see finalize)
+		'''
 		super().__init__('Tree Holder')
-		FractalBase.__init__(self, root)
+		FractalBase.__init__(self, root, use_store, batch, seed, rng)
 		self.num_primitives = 0
 		self.leaf_np = leaf_np
 		self.bark_texture = bark_texture
 		self.bodies_np = NodePath('Bodies')
 		self.leaves_np = NodePath('Leaves')
-		self.collision_np = self.attach_new_node(CollisionNode('Collision'))
+		self.collision_np = self.attach_new_node(CollisionTubes.make_node(()))
+		self.collision_min_radius = collision_min_radius
 		self.bodydata = GeomVertexData('body vertices',
 									   GeomVertexFormat.getV3n3t2(),
 									   Geom.UHStatic)
-		self.collision_np.show()
-		self.bark_ts = TextureStage('bark_ts')
-		self.bodies_np.set_texture(self.bark_ts, bark_texture)
+		self.bark_ts = TextureStage(self.BARK_TEXTURE_STAGE)
+		if bark_texture:
+			self.bodies_np.set_texture(self.bark_ts, bark_texture)
 		self.collision_np.reparent_to(self)
 		self.bodies_np.reparent_to(self)
 		self.leaves_np.reparent_to(self)
+		self.body_node: Optional[GeomNode] = None
+		if single_geom:
+			# all segments tristrips are drawn by one primitive
+			body_geom = Geom(self.bodydata)
+			body_geom.add_primitive(GeomTristrips(Geom.UHStatic))
+			self.body_node = GeomNode('Body')
+			self.body_node.add_geom(body_geom)
+			self.bodies_np.attach_new_node(self.body_node)
+			if Stats.enabled:
+				Stats.count('GeomNodes')
+		self.instanced_leaves: Optional[InstancedLeaves] = None
+		if instanced_leaves and leaf_np:
+			self.instanced_leaves = InstancedLeaves(leaf_np)
+			self.instanced_leaves.reparent_to(self.leaves_np)
+		# leaves are refreshed by ends diff: placed leaves are keyed by end key (see get_end_keys)
+		self.leaf_nodes: Dict[int, Tuple[NodePath, Vec3, Quat]] = {}
+		self.leaf_keys = np.zeros(0, np.int64) # instanced leaves rows
+		self.leaf_pos, self.leaf_quat = np.zeros((0, 3), np.float32), np.zeros((0, 4), np.float32)
+		self.placed_leaves_scale: Optional[float] = None
+		# ends diff collected since the last leaves refresh
+		self.pending_leaves: Dict[int, Tuple[List[float], List[float]]] = {}
+		self.pending_retired: Set[int] = set()
+		ends = self.store.ends if self.store is not None else list(self.iter_ends(self._root))
+		self.track_leaves(ends, ())
+		# deferred meshing: grown branches & ends diffs of grow steps since the last meshing
+		self.unmeshed_branches: List[Sequence] = []
+		self.unmeshed_ends: List[Tuple[Sequence, Sequence]] = []
+		self.unmeshed_leaves_scale: Optional[float] = None
+		self.mesh_trigger_np: Optional[NodePath] = None
+		self.meshing_task = None
+		if deferred_meshing:
+			# the node bounds enclose the skeleton: the cull callback is called when the tree is in view
+			def cull_callback(data, request_meshing = weakref.WeakMethod(self.request_meshing)): # the node should not keep the tree alive
+				data.upcall()
+				if (method := request_meshing()) is not None:
+					method()
 
+			trigger = CallbackNode('Deferred Meshing')
+			trigger.set_cull_callback(PythonCallbackObject(cull_callback))
+			self.mesh_trigger_np = self.attach_new_node(trigger)
+			pos = self.get_branch_store().pos[:1]
+			self.skeleton_bounds = (pos.min(axis=0), pos.max(axis=0))
+			self.skeleton_padding = 0. # the thickest end radius or the leaf size
+			self.extend_skeleton_bounds(ends)
+
+	@classmethod
+	def get_assets_props(cls) -> tuple:
+		'returns props of textures & models the tree is drawn with (see TreeCache)'
+		return ()
+
+	def save_skeleton(self, file_path: str) -> None:
+		'writes branches & scale of the tree to the skeleton file (see FractalBase.BranchStore.save)'
+		self.get_branch_store().save(file_path, self.get_scale().x)
+
+	def load_skeleton(self, file_path: str, leaves_scale = 1) -> None:
+		'''replaces the skeleton of not grown tree by the skeleton file & draws its branches and leaves
+		Arrays of the skeleton are mapped to memory (see FractalBase.BranchStore.load)
+		'''
+		store, scale = self.BranchStore.load(file_path)
+		# leaves of the previous ends are retired by keys of the previous branches
+		self.track_leaves((), self.store.ends if self.store is not None else list(self.iter_tree_ends()))
+		self.set_store(store)
+		self.set_scale(scale)
+		self.draw_branches(self.iter_branches())
+		self.track_leaves(self.added_ends, ())
+		self.refresh_leaves(leaves_scale)
+
+	@Stats.timed
 	def get_static(self) -> NodePath:
 		'makes a flattened version of the tree for faster rendering'
-		np = NodePath(self.node().copySubgraph())
-		np.flattenStrong()
-		return np
+		self.finalize()
+		static_np = NodePath(self.node().copySubgraph())
+		if self.mesh_trigger_np is not None:
+			static_np.find(self.mesh_trigger_np.get_name()).remove_node()
+		static_np.flattenStrong()
+		return static_np
+
+	def finalize(self, branches = True) -> None:
+		'''meshes branches grown since the last meshing by one bulk pass & refreshes leaves (see deferred_meshing)
+		branches -:- False - leaves only, for example LOD bodies are drawn from the skeleton (see make_lod_body)
+		'''
+		if branches and self.unmeshed_branches:
+			# a branch stopped by empty split stays an end & may be reported as grown by many steps
+			if self.store is not None:
+				grown = self.get_branches_props(np.unique(np.concatenate([np.asarray(rows, np.int32) for rows in self.unmeshed_branches])))
+			else:
+				grown = list({id(props): props for branches_props in self.unmeshed_branches for props in branches_props}.values())
+			self.unmeshed_branches = []
+			self.draw_branches(grown)
+		for added, retired in self.unmeshed_ends:
+			self.track_leaves(added, retired)
+		self.unmeshed_ends = []
+		if self.unmeshed_leaves_scale is not None:
+			self.refresh_leaves(self.unmeshed_leaves_scale)
+			self.unmeshed_leaves_scale = None
+
+	def request_meshing(self) -> None:
+		'schedules finalize() of deferred meshing: the tree is in view'
+		if self.meshing_task is None and (self.unmeshed_branches or self.unmeshed_ends):
+			self.meshing_task = base.taskMgr.add(self.meshing_task_func, 'Deferred Meshing', sort=-10)
+
+	def meshing_task_func(self, task):
+		self.meshing_task = None
+		self.finalize()
+		return task.done
+
+	def extend_skeleton_bounds(self, ends: Sequence, leaves_scale: Optional[float] = None) -> None:
+		'''extends bounds of the deferred meshing trigger node by the ends: branch start & tip points,
+		padded by the rings radius and the size of the leaves placed at the ends
+		ends -:- branch store rows or BranchProps
+		leaves_scale -:- scale of the leaves to be placed; None - no leaves
+		'''
+		if self.store is not None:
+			rows = np.asarray(ends, np.int64)
+			pos, radius = np.concatenate((self.store.pos[rows], self.store.next_pos(rows))), self.store.radius[rows]
+		else:
+			pos = np.array([tuple(point) for branch in ends for point in (branch.pos, branch.next_pos())], np.float32).reshape(-1, 3)
+			radius = np.array([branch.radius for branch in ends], np.float32)
+		if len(radius):
+			self.skeleton_padding = max(self.skeleton_padding, float(radius.max()))
+		if leaves_scale is not None and self.leaf_np is not None:
+			leaf_bounds = self.leaf_np.get_bounds()
+			if not leaf_bounds.is_empty():
+				self.skeleton_padding = max(self.skeleton_padding,
+					(leaf_bounds.get_center().length() + leaf_bounds.get_radius()) * leaves_scale)
+		bounds_min, bounds_max = self.skeleton_bounds
+		if len(pos):
+			self.skeleton_bounds = bounds_min, bounds_max = np.minimum(bounds_min, pos.min(axis=0)), np.maximum(bounds_max, pos.max(axis=0))
+		padding = self.skeleton_padding
+		self.mesh_trigger_np.node().set_bounds(BoundingBox(Point3(*(bounds_min - padding).tolist()), Point3(*(bounds_max + padding).tolist())))
+
+	def get_body_arrays(self, bodies_np: Optional[NodePath] = None) -> Tuple[np.ndarray, np.ndarray]:
+		'''returns body vertices as rows of vertex format V3N3T2 and triangles vertex indexes
+		Arrays can be sent to other process and wrapped by make_body_node
+
+		bodies_np -:- GeomNodes sharing one vertex data; None - tree bodies
+		'''
+		vdata, indices = self.bodydata, []
+		for geom_np in (self.bodies_np if bodies_np is None else bodies_np).find_all_matches('**/+GeomNode'):
+			geom_node = geom_np.node()
+			for i in range(geom_node.get_num_geoms()):
+				vdata = geom_node.get_geom(i).get_vertex_data()
+				for primitive in geom_node.get_geom(i).decompose().get_primitives():
+					indices.append(np.frombuffer(memoryview(primitive.get_vertices()).cast('B'),
+						np.uint16 if primitive.get_index_type() == Geom.NT_uint16 else np.uint32))
+		vertices = np.frombuffer(memoryview(vdata.get_array(0)).cast('B'), np.float32).reshape(-1, 8)
+		return vertices, np.concatenate(indices).astype(np.uint32) if indices else np.zeros(0, np.uint32)
+
+	@staticmethod
+	def make_body_node(vertices: np.ndarray, indices: np.ndarray, name = 'Body') -> GeomNode:
+		'''wraps body arrays of get_body_arrays into GeomNode
+		Arrays are copied to Panda3D buffers by one bulk copy
+		'''
+		vdata = GeomVertexData('body vertices', GeomVertexFormat.getV3n3t2(), Geom.UHStatic)
+		vdata.unclean_set_num_rows(len(vertices))
+		memoryview(vdata.modify_array(0)).cast('B')[:] = memoryview(vertices).cast('B')
+		triangles = GeomTriangles(Geom.UHStatic)
+		triangles.set_index_type(Geom.NT_uint32)
+		vertices_indices = triangles.modify_vertices()
+		vertices_indices.unclean_set_num_rows(len(indices))
+		memoryview(vertices_indices).cast('B')[:] = memoryview(indices).cast('B')
+		geom = Geom(vdata)
+		geom.add_primitive(triangles)
+		geom_node = GeomNode(name)
+		geom_node.add_geom(geom)
+		if Stats.enabled:
+			Stats.count('GeomNodes')
+			Stats.count('vertex rows', len(vertices))
+			Stats.count('primitives')
+		return geom_node
+
+	def make_lod_body(self, level: LODLevel) -> GeomNode:
+		'draws the whole body of the tree as one Geom with LOD level detail'
+		vdata = GeomVertexData('body vertices', GeomVertexFormat.getV3n3t2(), Geom.UHStatic)
+		body_geom = Geom(vdata)
+		body_geom.add_primitive(GeomTristrips(Geom.UHStatic))
+		body_node = GeomNode('Body')
+		body_node.add_geom(body_geom)
+		if Stats.enabled:
+			Stats.count('GeomNodes')
+		self.add_segments(vdata,
+			self.get_branch_segments(props for props in self.iter_branches() if props.radius >= level.min_radius),
+			level.num_side_slices, body_node)
+		return body_node
+
+	def get_lod(self, levels: Optional[Iterable[LODLevel]] = None, impostor_distance: Optional[Tuple[float, float]] = IMPOSTOR_DISTANCE,
+			impostor_size = 256) -> NodePath:
+		'''makes LOD version of the tree: flattened meshes of reduced details and billboard card
+		levels -:- None - LOD_LEVELS
+		impostor_distance -:- near, far switch distances of billboard card; None - without card
+		'''
+		return self.make_lod(((level, self.make_lod_body(level)) for level in (self.LOD_LEVELS if levels is None else levels)),
+			impostor_distance, impostor_size)
+
+	@Stats.timed
+	def make_lod(self, level_bodies: Iterable[Tuple[LODLevel, GeomNode]], impostor_distance: Optional[Tuple[float, float]] = IMPOSTOR_DISTANCE,
+			impostor_size = 256) -> NodePath:
+		'''makes LOD version of the tree from bodies of the levels
+		The tree leaves are added to every level; billboard card is rendered from the first level
+		'''
+		return FrameScheduler.complete(self.iter_make_lod(level_bodies, impostor_distance, impostor_size))
+
+	def iter_make_lod(self, level_bodies: Iterable[Tuple[LODLevel, GeomNode]], impostor_distance: Optional[Tuple[float, float]] = IMPOSTOR_DISTANCE,
+			impostor_size = 256) -> Iterator[None]:
+		'resumable make_lod(): yields after every level & until billboard card is rendered'
+		self.finalize(branches=False)
+		lod = LODNode('Tree LOD')
+		lod_np = NodePath(lod)
+		lod_np.set_state(self.get_state())
+		lod_np.set_transform(self.get_transform())
+		if self.collision_min_radius is not None:
+			# children of LODNode are the levels: collision tubes are kept as python tag (see ForestGrid.add_cell_collision)
+			lod_np.set_python_tag(self.COLLISION_TAG, self.get_collision_tubes(self.collision_min_radius))
+		for i, (level, body_node) in enumerate(level_bodies):
+			level_np = lod_np.attach_new_node(f'LOD {i}')
+			level_np.attach_new_node(body_node).set_state(self.bodies_np.get_state())
+			self.leaves_np.copy_to(level_np)
+			level_np.flatten_strong()
+			lod.add_switch(level.far, level.near)
+			yield
+		if impostor_distance and lod.get_num_children():
+			if (card_np := (yield from self.iter_make_impostor(lod_np.get_child(0), lod_np, impostor_size))):
+				card_np.reparent_to(lod_np)
+				lod.add_switch(impostor_distance[1], impostor_distance[0])
+		return lod_np
+
+	@staticmethod
+	def make_impostor(level_np: NodePath, lod_np: NodePath, size = 256) -> Optional[NodePath]:
+		'''renders the tree offscreen from the side and returns the billboard card with the image
+		Returns None if offscreen buffer is not available
+		'''
+		return FrameScheduler.complete(FractalTree.iter_make_impostor(level_np, lod_np, size))
+
+	@staticmethod
+	def iter_make_impostor(level_np: NodePath, lod_np: NodePath, size = 256) -> Iterator:
+		'''resumable make_impostor(): the tree is rendered by one-shot offscreen buffer with the next frame,
+		yields FrameScheduler.NEXT_FRAME until the image is rendered
+		'''
+		if base.pipe is None:
+			# window-type none
+			return None
+		bounds_min, bounds_max = level_np.get_tight_bounds(lod_np)
+		center, extent = (bounds_min + bounds_max) / 2, bounds_max - bounds_min
+		width = max(extent.x, extent.y)
+		fb_props = FrameBufferProperties()
+		fb_props.set_rgba_bits(8, 8, 8, 8)
+		fb_props.set_depth_bits(16)
+		buffer = base.graphicsEngine.make_output(base.pipe, 'impostor buffer', -100, fb_props,
+			WindowProperties.size(size, size), GraphicsPipe.BF_refuse_window,
+			base.win.get_gsg() if base.win else None, base.win)
+		if not buffer:
+			return None
+		buffer.set_one_shot(True) # the buffer is inactive after the frame is rendered
+		texture = Texture('impostor')
+		buffer.add_render_texture(texture, GraphicsOutput.RTM_copy_ram)
+		buffer.set_clear_color_active(True)
+		buffer.set_clear_color(Vec4(0, 0, 0, 0))
+		# render the tree with orthographic camera looking along Y axis
+		scene_np = NodePath('impostor scene')
+		scene_np.set_state(lod_np.get_state())
+		level_np.instance_to(scene_np)
+		lens = OrthographicLens()
+		lens.set_film_size(width, extent.z)
+		lens.set_near_far(1, extent.y + 2)
+		camera_np = scene_np.attach_new_node(Camera('impostor camera', lens))
+		camera_np.set_pos(center.x, bounds_min.y - 1, center.z)
+		buffer.make_display_region().set_camera(camera_np)
+		while buffer.is_active() or not texture.has_ram_image():
+			yield FrameScheduler.NEXT_FRAME
+			if not buffer.is_valid(): # not opened
+				base.graphicsEngine.remove_window(buffer)
+				return None
+		base.graphicsEngine.remove_window(buffer)
+		# make billboard card
+		card = CardMaker('impostor')
+		card.set_frame(-width / 2, width / 2, bounds_min.z, bounds_max.z)
+		card_np = NodePath(card.generate())
+		card_np.set_pos(center.x, center.y, 0)
+		card_np.set_texture(texture)
+		card_np.set_transparency(TransparencyAttrib.MDual)
+		card_np.set_billboard_axis()
+		return card_np
 
 	def make_collision(self, pos: Vec3, new_pos: Vec3, radius: float) -> None:
 		'''
@@ -89,6 +474,60 @@ class FractalTree(NodePath, FractalBase):
 		'''
 		tube = CollisionTube(Point3(pos), Point3(new_pos), radius)
 		self.collision_np.node().addSolid(tube)
+		if Stats.enabled:
+			Stats.count('collision solids')
+
+	def get_collision_tubes(self, min_radius: Optional[float] = None, merge_level: Optional[int] = None) -> np.ndarray:
+		'''returns collision tubes (n, 7) of the branches having children: start & end points, radius (see CollisionTubes)
+		min_radius -:- thinner branches are dropped; None - COLLISION_MIN_RADIUS
+		merge_level -:- every subtree growing from a branch of this level (the root is level 0) is merged
+			to one coarse capsule enclosing the subtree tubes; None - tube per branch
+		'''
+		store = self.get_branch_store()
+		size = len(store)
+		rows = np.flatnonzero((store.children_count[:size] > 0)
+			& (store.radius[:size] >= (self.COLLISION_MIN_RADIUS if min_radius is None else min_radius)))
+		tubes = np.column_stack((store.pos[rows], store.next_pos(rows), store.radius[rows])).astype(np.float32)
+		if merge_level is None or not len(rows):
+			return tubes
+		# level of every branch: count of ancestors
+		levels, ancestors = np.zeros(size, np.int32), store.parent[:size].copy()
+		while (has_ancestor := ancestors >= 0).any():
+			levels[has_ancestor] += 1
+			ancestors[has_ancestor] = store.parent[ancestors[has_ancestor]]
+		# capsule of every subtree: from the subtree root start to the farthest tube point
+		groups = rows.copy()
+		while (deeper := levels[groups] > merge_level).any():
+			groups[deeper] = store.parent[groups[deeper]]
+		groups, inverse = np.unique(groups, return_inverse=True)
+		points, point_groups = np.concatenate((tubes[:, :3], tubes[:, 3:6])), np.tile(inverse, 2)
+		starts = store.pos[groups][point_groups]
+		order = np.lexsort((np.linalg.norm(points - starts, axis=1), point_groups))
+		ends = points[order[np.flatnonzero(np.diff(point_groups[order], append=len(groups)))]]
+		axes = ends[point_groups] - starts
+		t = np.clip(np.einsum('ij,ij->i', points - starts, axes) / np.maximum(np.einsum('ij,ij->i', axes, axes), 1e-12), 0, 1)
+		radii = np.zeros(len(groups), np.float32)
+		np.maximum.at(radii, point_groups, np.linalg.norm(points - starts - axes * t[:, None], axis=1) + np.tile(tubes[:, 6], 2))
+		return np.column_stack((store.pos[groups], ends, radii)).astype(np.float32)
+
+	def set_collision(self, tubes: np.ndarray, leaf_size: Optional[int] = None) -> None:
+		'''replaces collision solids of the tree by the tubes
+		leaf_size -:- arrange the tubes to bounding volume hierarchy with up to leaf_size tubes per collision node
+			(see CollisionTubes.make_hierarchy); None - all tubes at one collision node
+		'''
+		node = self.collision_np.node()
+		node.clear_solids()
+		self.collision_np.get_children().detach()
+		if leaf_size is None:
+			CollisionTubes.add_solids(node, tubes)
+		else:
+			CollisionTubes.make_hierarchy(tubes, leaf_size).reparent_to(self.collision_np)
+
+	def add_collision_tubes(self, segments: List[Tuple[FractalBase.BranchProps, FractalBase.BranchProps, float]]) -> None:
+		'adds collision tubes of cylinders of get_branch_segments not thinner than collision_min_radius'
+		for props, child_props, _ in segments:
+			if props.radius >= self.collision_min_radius:
+				self.make_collision(props.pos, child_props.pos, props.radius)
 
 	def draw_branch(self, props: FractalBase.BranchProps, num_side_slices = 12) -> None:
 		'''draws the body of the tree as cylinder
@@ -96,159 +535,281 @@ class FractalTree(NodePath, FractalBase):
 
 		props -:- should have child branches
 		'''
+		self.draw_branches((props, ), num_side_slices)
 
-		if not props.branches:
-			return
+	@Stats.timed
+	def draw_branches(self, props_list: Iterable[FractalBase.BranchProps], num_side_slices = 12) -> None:
+		'''draws the bodies of the branches as cylinders
+		Rings of all branches are tessellated and written to vertex data in bulk.
 
-		# print(f'draw_branch: {props}')
-		def add_branch(branch_props, child_branch_props):
-			vdata = self.bodydata
-			circle_geom = Geom(vdata)
-			vert_writer = GeomVertexWriter(vdata, "vertex")
-			normal_writer = GeomVertexWriter(vdata, "normal")
-			tex_rewriter = GeomVertexRewriter(vdata, "texcoord")
-			start_row = vdata.get_num_rows() # index of first vertex of current drawing branch
-			vert_writer.set_row(start_row)
-			normal_writer.set_row(start_row)
-			tex_rewriter.set_row(start_row)
-			tex_v_coord = props.total_length # get total length from root to current branch
-			slice_angle = 2 * math.pi / num_side_slices
-
-			def add_circle(props: FractalBase.BranchProps, radius = None):
-				'adds cylinder circle'
-				curr_angle, perp1, perp2 = 0, props.direction.get_right(), props.direction.get_forward()
-				pos, radius = props.pos, props.radius if radius is None else radius
-				# print(f'{pos=}')
-				# add cylinder side circle slice by slice
-				# face side vertex order is left to right ->
-				# Example for branch{pos=(0, 0, 0) radius=1} num_side_slices = 4:
-				# vertexes positions: (1, 0, 0), (0, 1, 0), (-1, 0, 0), (0, -1, 0)
-				# texture UV coords:  (0, 0),    (0.25, 0), (0.5, 0),   (0.75, 0)
-				for i in range(num_side_slices + 1): # doubles the last vertex to fix UV seam
-					# add vertex, normal & texture coord
-					normal = perp1 * math.cos(curr_angle) + perp2 * math.sin(curr_angle)
-					vert_pos = pos + normal * radius
-					# print(f'{i} {vert_pos}')
-					normal_writer.add_data3f(normal)
-					vert_writer.add_data3f(vert_pos)
-					tex_rewriter.add_data2f(i / num_side_slices, tex_v_coord)
-					curr_angle += slice_angle
-
-			# add first circle of cylinder
-			add_circle(branch_props)
-			# add second circle of cylinder
-			tex_v_coord += branch_props.length
-			add_circle(child_branch_props)
-
-			# Use Tristrips geom to draw cylinder side slices. One slice vertex order:
-			# 0 2 # second circle # self.bodydata vertex indexes: 2, 3
-			# 1 3 # first circle  # self.bodydata vertex indexes: 0, 1
-			# Example self.bodydata vertex indexes for num_side_slices = 4:
-			# 4 5 6 7 # second circle
-			# 0 1 2 3 # first circle
-			lines = GeomTristrips(Geom.UHStatic)
-			# start_row: index of first vertex of first circle # doubles the last vertex to fix UV seam
-			for i in range(start_row, start_row + num_side_slices + 2):
-				lines.add_vertex(i + num_side_slices) # second circle
-				lines.add_vertex(i) # first circle
-			lines.close_primitive()
-			# lines.decompose()
-			circle_geom.add_primitive(lines)
-			circle_geom_node = GeomNode("Debug")
-			circle_geom_node.add_geom(circle_geom)
-			self.num_primitives += num_side_slices * 2
-			self.bodies_np.attach_new_node(circle_geom_node)
-
-		child_max_radius, child_max_angle = max(props.branches, key=lambda br: br.radius), max((math.fabs(br.direction.get_angle()) for br in props.branches))
-		if child_max_angle > 65:
-			# print(f'{child_max_angle=}')
-			child_branch_props = props.create_next(props.length + child_max_radius.radius, props.length + child_max_radius.radius, child_max_radius.radius)
-			add_branch(props, child_branch_props)
-			child_branch_props2 = child_branch_props.create_next(child_branch_props.radius, child_branch_props.radius, 0)
-			add_branch(child_branch_props, child_branch_props2)
-			# print('MIDDLE')
-			# middle_branch_props = FractalBase.BranchProps(
-			# 	props.pos,
-			# 	props.direction,
-			# 	props.length - child_branch_props.radius, props.radius, props.branches, props.total_length, props.branch_length
-			# )
-			# middle_branch_props2 = FractalBase.BranchProps(
-			# 	middle_branch_props.next_pos(0),
-			# 	middle_branch_props.direction,
-			# 	middle_branch_props.radius, 0, middle_branch_props.branches, props.total_length, props.branch_length
-			# )
-			# add_branch(middle_branch_props, middle_branch_props2)
-			# add_branch(middle_branch_props2, child_branch_props)
-		else:
-			add_branch(props, child_max_radius)
+		props_list -:- branches without child branches are skipped
+		'''
+		if (segments := self.get_branch_segments(props_list)):
+			self.num_primitives += num_side_slices * 2 * len(segments)
+			self.add_segments(self.bodydata, segments, num_side_slices, self.body_node)
+			if self.collision_min_radius is not None:
+				self.add_collision_tubes(segments)
 
-	def draw_leaf(self, pos=Vec3(0, 0, 0), quat=None, scale=0.125):
+	@staticmethod
+	def get_branch_segments(props_list: Iterable[FractalBase.BranchProps]) -> List[Tuple[FractalBase.BranchProps, FractalBase.BranchProps, float]]:
+		'''returns cylinders to draw the branches: (branch_props, child_branch_props, tex_v_coord)
+		props_list -:- branches without child branches are skipped
 		'''
-		draws leafs when we reach an end
+		segments = []
+
+		for props in props_list:
+			if not props.branches:
+				continue
+			# print(f'draw_branch: {props}')
+			tex_v_coord = props.total_length # get total length from root to current branch
+			child_max_radius, child_max_angle = max(props.branches, key=lambda br: br.radius), max((math.fabs(br.direction.get_angle()) for br in props.branches))
+			if child_max_angle > 65:
+				# print(f'{child_max_angle=}')
+				child_branch_props = props.create_next(props.length + child_max_radius.radius, props.length + child_max_radius.radius, child_max_radius.radius)
+				segments.append((props, child_branch_props, tex_v_coord))
+				child_branch_props2 = child_branch_props.create_next(child_branch_props.radius, child_branch_props.radius, 0)
+				segments.append((child_branch_props, child_branch_props2, tex_v_coord))
+				# print('MIDDLE')
+				# middle_branch_props = FractalBase.BranchProps(
+				# 	props.pos,
+				# 	props.direction,
+				# 	props.length - child_branch_props.radius, props.radius, props.branches, props.total_length, props.branch_length
+				# )
+				# middle_branch_props2 = FractalBase.BranchProps(
+				# 	middle_branch_props.next_pos(0),
+				# 	middle_branch_props.direction,
+				# 	middle_branch_props.radius, 0, middle_branch_props.branches, props.total_length, props.branch_length
+				# )
+				# segments.append((middle_branch_props, middle_branch_props2, tex_v_coord))
+				# segments.append((middle_branch_props2, child_branch_props, tex_v_coord))
+			else:
+				segments.append((props, child_max_radius, tex_v_coord))
+		return segments
+
+	def add_segments(self, vdata: GeomVertexData, segments: List[Tuple[FractalBase.BranchProps, FractalBase.BranchProps, float]],
+			num_side_slices: int, body_node: Optional[GeomNode]) -> None:
+		'''tessellates cylinders of get_branch_segments to the vertex data
+		body_node -:- GeomNode with one tristrips Geom to append to; None - GeomNode per cylinder under bodies_np
 		'''
+		# add first & second circles of every cylinder
+		circles = [(circle_props, tex_v_coord + (branch_props.length if i else 0))
+			for branch_props, child_branch_props, tex_v_coord in segments
+			for i, circle_props in enumerate((branch_props, child_branch_props))]
+		start_row = RingMesh.append_rows(vdata, RingMesh.make_rings(
+			[tuple(props.pos) for props, _ in circles],
+			[tuple(props.direction.get_right()) for props, _ in circles],
+			[tuple(props.direction.get_forward()) for props, _ in circles],
+			[props.radius for props, _ in circles],
+			[tex_v_coord for _, tex_v_coord in circles],
+			num_side_slices)) # index of first vertex of current drawing branches
+
+		# Use Tristrips geom to draw cylinder side slices. One slice vertex order:
+		# 0 2 # second circle # self.bodydata vertex indexes: 2, 3
+		# 1 3 # first circle  # self.bodydata vertex indexes: 0, 1
+		# first rows: index of first vertex of first circle of every cylinder
+		first_rows = range(start_row, start_row + len(circles) * (num_side_slices + 1), 2 * (num_side_slices + 1))
+		if body_node:
+			# append strips to the shared primitive # modify_* marks Geom & GeomNode bounds as stale
+			RingMesh.add_strips(body_node.modify_geom(0).modify_primitive(0), first_rows, num_side_slices)
+		else:
+			for first_row in first_rows:
+				lines = GeomTristrips(Geom.UHStatic)
+				RingMesh.add_strips(lines, (first_row, ), num_side_slices)
+				circle_geom = Geom(vdata)
+				circle_geom.add_primitive(lines)
+				circle_geom_node = GeomNode("Debug")
+				circle_geom_node.add_geom(circle_geom)
+				self.bodies_np.attach_new_node(circle_geom_node)
+			if Stats.enabled:
+				Stats.count('GeomNodes', len(first_rows))
+
+	@staticmethod
+	def get_leaf_transform(pos: Vec3, quat: Quat, scale: float) -> TransformState:
 		# use the vectors that describe the direction the branch grows to make
 		# the right rotation matrix
 		new_cs = Mat4()
 		quat.extract_to_matrix(new_cs)
-		axis_adj = Mat4.scale_mat(scale) * new_cs * Mat4.translate_mat(pos)
+		return TransformState.make_mat(Mat4.scale_mat(scale) * new_cs * Mat4.translate_mat(pos))
+
+	def draw_leaf(self, pos=Vec3(0, 0, 0), quat=None, scale=0.125) -> NodePath:
+		'''
+		draws leafs when we reach an end
+		'''
 		leaf_np = NodePath("leaf")
 		self.leaf_np.instance_to(leaf_np)
 		leaf_np.reparent_to(self.leaves_np)
-		leaf_np.set_transform(TransformState.make_mat(axis_adj))
+		leaf_np.set_transform(self.get_leaf_transform(pos, quat, scale))
+		return leaf_np
 
+	def get_end_keys(self, ends: Sequence) -> List[int]:
+		'returns keys of ends: branch store rows or ids of BranchProps'
+		return np.asarray(ends, np.int64).tolist() if self.store is not None else [id(branch) for branch in ends]
+
+	def get_end_arrays(self, ends: Sequence) -> Tuple[np.ndarray, np.ndarray]:
+		'returns positions (n, 3) & Quat directions (n, 4) of ends: branch store rows or BranchProps'
+		if self.store is not None:
+			ends = np.asarray(ends, np.int64)
+			return self.store.pos[ends], self.store.quat[ends]
+		return (np.array([tuple(branch.pos) for branch in ends], np.float32).reshape(-1, 3),
+			np.array([tuple(branch.direction) for branch in ends], np.float32).reshape(-1, 4))
+
+	def track_leaves(self, added: Sequence, retired: Sequence) -> None:
+		'collects ends diff of grow step to pending leaves changes'
+		for key in self.get_end_keys(retired):
+			if self.pending_leaves.pop(key, None) is None:
+				# the leaf is placed already
+				self.pending_retired.add(key)
+		pos, quat = self.get_end_arrays(added)
+		self.pending_leaves.update(zip(self.get_end_keys(added), zip(pos.tolist(), quat.tolist())))
+
+	@Stats.timed
+	def refresh_leaves(self, leaves_scale=1) -> None:
+		'''updates leaves by ends diff collected since the last refresh:
+		removes leaves of retired ends, places leaves at added ends; kept leaves are rescaled if leaves_scale changed
+		'''
+		retired, added = self.pending_retired, self.pending_leaves
+		self.pending_retired, self.pending_leaves = set(), {}
+		if self.leaf_np is None:
+			# geometry only tree (for worker processes): leaves are not placed, ends are taken by get_ends_arrays
+			return
+		rescale = self.placed_leaves_scale is not None and leaves_scale != self.placed_leaves_scale
+		self.placed_leaves_scale = leaves_scale
+		if Stats.enabled:
+			Stats.count('leaves added', len(added))
+			Stats.count('leaves removed', len(retired))
+		if self.instanced_leaves:
+			keep = ~np.isin(self.leaf_keys, np.fromiter(retired, np.int64, len(retired)))
+			pos = np.array([pos for pos, _ in added.values()], np.float32).reshape(-1, 3)
+			quat = np.array([quat for _, quat in added.values()], np.float32).reshape(-1, 4)
+			self.leaf_keys = np.concatenate((self.leaf_keys[keep], np.fromiter(added, np.int64, len(added))))
+			self.leaf_pos = np.concatenate((self.leaf_pos[keep], pos))
+			self.leaf_quat = np.concatenate((self.leaf_quat[keep], quat))
+			if rescale:
+				matrices = InstancedLeaves.get_matrices(self.leaf_pos, self.leaf_quat, leaves_scale)
+			else:
+				matrices = np.concatenate((self.instanced_leaves.matrices[keep], InstancedLeaves.get_matrices(pos, quat, leaves_scale)))
+			self.instanced_leaves.set_transforms(matrices)
+			if Stats.enabled:
+				Stats.level('leaves', len(self.leaf_keys))
+			return
+		for key in retired:
+			if (leaf := self.leaf_nodes.pop(key, None)) is not None:
+				leaf[0].remove_node()
+		if rescale:
+			for leaf_np, pos, quat in self.leaf_nodes.values():
+				leaf_np.set_transform(self.get_leaf_transform(pos, quat, leaves_scale))
+		for key, (pos, quat) in added.items():
+			pos, quat = Vec3(*pos), Quat(*quat)
+			self.leaf_nodes[key] = (self.draw_leaf(pos, quat, leaves_scale), pos, quat)
+		if Stats.enabled:
+			Stats.level('leaves', len(self.leaf_nodes))
+
+	@Stats.timed
 	def grow(self, refresh_leaves=False, leaves_scale=1, scale=1.125):
 		'''
 		grows the tree for num steps
+		Leaves are refreshed by ends diff: only leaves of retired ends are removed & only new ends get leaves
 		'''
+		FrameScheduler.complete(self.iter_grow(refresh_leaves, leaves_scale, scale))
+
+	def iter_grow(self, refresh_leaves=False, leaves_scale=1, scale=1.125) -> Iterator[None]:
+		'resumable grow(): yields after skeleton growth & after branches meshing'
 		self.set_scale(self, scale)
 		# self.leaf_np.setScale(self.leaf_np, leaves_scale / scale)
+		grown = FractalBase.grow(self, props=False)
+		if self.mesh_trigger_np is not None:
+			# deferred meshing
+			self.unmeshed_branches.append(grown)
+			self.unmeshed_ends.append((self.added_ends, self.retired_ends))
+			if refresh_leaves:
+				self.unmeshed_leaves_scale = leaves_scale
+			self.extend_skeleton_bounds(self.added_ends, leaves_scale if refresh_leaves else None)
+			return
+		yield
+		self.draw_branches(self.get_branches_props(grown))
+		self.track_leaves(self.added_ends, self.retired_ends)
 		if refresh_leaves:
-			# remove old generated leaves
-			for c in self.leaves_np.get_children():
-				c.remove_node()
-		for prop in super().grow():
-			self.draw_branch(prop)
-		if refresh_leaves:
-			for prop in self.iter_ends(self.root):
-				if not prop.branches:
-					# no children branches # place leaf
-					self.draw_leaf(prop.pos, prop.direction, leaves_scale)
+			yield
+			self.refresh_leaves(leaves_scale)
+
+	def iter_build(self, grow_steps: int, leaves_scale=1, lod_levels: Optional[Iterable[LODLevel]] = None,
+			impostor_distance: Optional[Tuple[float, float]] = IMPOSTOR_DISTANCE) -> Iterator:
+		'''resumable tree generation by this process by small steps: growth, meshing, LOD levels & flattening (see FrameScheduler)
+		Returns flattened tree (see get_static) or LOD tree (see get_lod); both keep the tree collision
+		lod_levels -:- None - flattened tree
+		'''
+		for i in range(grow_steps):
+			yield from self.iter_grow(i == grow_steps - 1, leaves_scale)
+			yield
+		if not lod_levels:
+			return self.get_static()
+		level_bodies = []
+		for level in lod_levels:
+			level_bodies.append((level, self.make_lod_body(level)))
+			yield
+		return (yield from self.iter_make_lod(level_bodies, impostor_distance))
 
 	def get_next_branches_count(self, branch: FractalBase.BranchProps) -> int:
 		if branch.length < self.branch_min_len or branch.total_length > 35:
 			# stop grow this branch
 			return 0
-		if random.random() < .3:
+		if self.random.random() < .3:
 			# continue one branch
 			return 1
 		# split to multiple branchs
-		if random.random() < .8:
+		if self.random.random() < .8:
 			return 2
 		return 3
 
+	def get_next_branches_counts(self, rows: np.ndarray) -> np.ndarray:
+		split = self.batch_random.random((2, len(rows)))
+		counts = np.where(split[0] < .3, 1, np.where(split[1] < .8, 2, 3))
+		# stop grow this branches
+		counts[(self.store.length[rows] < self.branch_min_len) | (self.store.total_length[rows] > 35)] = 0
+		return counts
+
 
 class DefaultTree(FractalTree):
 
 	BARK_TEXTURE = TextureProps('models/barkTexture.jpg', Vec2(2, .25), Texture.FTLinearMipmapLinear, Texture.WM_mirror, None, 16)
 	LEAF_MODEL_PATH = 'models/shrubbery'
 	LEAF_TEXTURE_PATH = 'models/material-10-cl.png'
+	LEAF_TEXTURE = TextureProps(LEAF_TEXTURE_PATH, minfilter=Texture.FTLinearMipmapLinear)
 
-	def __init__(self):
+	def __init__(self, use_store = False, batch = False, seed: Optional[int] = None, rng: Optional[random.Random] = None,
+			load_assets = True, single_geom = False, instanced_leaves = False,
+			collision_min_radius: Optional[float] = FractalTree.COLLISION_MIN_RADIUS, deferred_meshing = False,
+			texture_loader: Optional[TextureLoader] = None):
+		'''
+		load_assets -:- load bark texture & leaf model with base.loader; False - geometry only tree (for worker processes)
+		texture_loader -:- loads the textures by background threads; None - blocking load
+		'''
+		bark_texture, leaf_np = self.load_assets(texture_loader) if load_assets else (None, None)
+		super().__init__(bark_texture, leaf_np,
+			FractalBase.BranchProps(Vec3(0, 0, 0), Quat(), 5, 1, []), use_store, batch, seed, rng, single_geom, instanced_leaves,
+			collision_min_radius, deferred_meshing)
+		self.set_tex_scale(self.bark_ts, *(
+			self.BARK_TEXTURE.scale.x * self.random.uniform(.5, 1.5), self.BARK_TEXTURE.scale.y * self.random.uniform(.5, 1.5))
+		)
+
+	@classmethod
+	def get_assets_props(cls) -> tuple:
+		return (cls.BARK_TEXTURE, cls.LEAF_MODEL_PATH, cls.LEAF_TEXTURE_PATH)
+
+	@classmethod
+	def load_assets(cls, texture_loader: Optional[TextureLoader] = None) -> Tuple[Texture, NodePath]:
+		'''returns bark texture & leaf model
+		texture_loader -:- the textures are placeholders until loaded by background threads; None - blocking load
+		'''
 		# set bark texture
-		bark_texture = base.loader.loadTexture(self.BARK_TEXTURE.path)
-		self.BARK_TEXTURE.set_texture_props(bark_texture)
+		bark_texture = cls.BARK_TEXTURE.load(loader=texture_loader)
 		# set leaf texture
-		leaf_np = base.loader.loadModel(self.LEAF_MODEL_PATH)
+		leaf_np = base.loader.loadModel(cls.LEAF_MODEL_PATH)
 		leaf_np.clear_model_nodes()
 		leaf_np.flatten_strong()
-		leafTexture = base.loader.loadTexture(self.LEAF_TEXTURE_PATH)
-		leafTexture.set_minfilter(Texture.FTLinearMipmapLinear)
+		leafTexture = cls.LEAF_TEXTURE.load(loader=texture_loader)
 		leaf_np.set_texture(leafTexture, 1)
-		super().__init__(bark_texture, leaf_np,
-			FractalBase.BranchProps(Vec3(0, 0, 0), Quat(), 5, 1, []))
-		self.set_tex_scale(self.bark_ts, *(
-			self.BARK_TEXTURE.scale.x * random.uniform(.5, 1.5), self.BARK_TEXTURE.scale.y * random.uniform(.5, 1.5))
-		)
+		return bark_texture, leaf_np
 
 
 if __name__ == "__main__":
@@ -256,16 +817,25 @@ if __name__ == "__main__":
 	from direct.gui.DirectRadioButton import DirectRadioButton
 	from os import uname
 	from RadioButtons import RadioButtons
+	from Forest import ForestBuilder, ForestGrid, TreePool
+	from AssetWatcher import AssetWatcher
 
 	global demo_running
 	base, demo_running = ShowBase(), True
+	from TextureBake import TextureBake
+	texture_loader = TextureLoader(bake=TextureBake()) # textures are baked once & loaded while the scene is shown
+	# changed textures & shaders files are reloaded while the demo runs
+	asset_watcher = AssetWatcher()
+	for props in (DefaultTree.BARK_TEXTURE, DefaultTree.LEAF_TEXTURE):
+		asset_watcher.watch_texture(props.load(loader=texture_loader), props, texture_loader)
+	asset_watcher.watch_shader(base.render, *InstancedLeaves.SHADER_PATHS)
 
 	props = WindowProperties()
 	props.set_title(f'Panda3D Workbench - (P3D {PandaSystem.get_version_string()} on {uname().sysname} {uname().release} {uname().machine})')
 	base.win.request_properties(props)
 
 
-	def look_camera_at_entire_object(np: NodePath, camera=base.cam, lense=base.camLens):
+	def look_camera_at_entire_object(node_np: NodePath, camera=base.cam, lense=base.camLens):
 
 		def get_distance(radius) -> float:
 			if lense:
@@ -273,58 +843,77 @@ if __name__ == "__main__":
 				return radius / math.tan(math.radians(min(fov[0], fov[1]) / 2.))
 			return 50.
 
-		bounds = np.get_bounds()
+		bounds = node_np.get_bounds()
 		camera.set_pos(Vec3.forward() * get_distance(bounds.get_radius()))
 		camera.look_at(bounds.get_center())
 
-	def forest():
+	def forest(templates_count: Optional[int] = None):
+		'''
+		templates_count -:- place instances of the pool of templates trees; None - every tree is unique
+		'''
 		global demo_running
 		demo_running = True
 		terrain_size, terrain_pos = Vec3(512, 512, 10), Vec2(-256, -256)
-		trees_count = 100
-
-		def create_tree():
-			count = 10
-			t = DefaultTree()
-			for _ in range(count):
-				if _ == count - 1:
-					t.grow(True, leaves_scale=random.uniform(.1, .15))
-				else:
-					t.grow()
-			return t
+		trees_count = 100 if templates_count is None else 5000
 
 		def forest_task(task):
-			'place tree at terrain'
+			'schedules wrapping of generated trees; trees are wrapped by frame budgeted steps'
 			global demo_running
-			nonlocal count, text, text2
+			nonlocal rebuilding
 			if count < trees_count and demo_running:
-				if not text:
-					text = OnscreenText('FOREST GENERATION', scale=.1, fg=(.6, .5, .2, 1), bg=(0, 0, 0, .5), shadow=(0.5,0.5,0.5,1), frame=(0.05,0.05,0.05,1))
-				if not text2:
-					text2 = OnscreenText(f'{count}', pos=(0, -.15), scale=.05, fg=(.6, .5, .2, 1), bg=(0, 0, 0, .5), shadow=(0.5,0.5,0.5,1), frame=(0.05,0.05,0.05,1))
-				else:
-					text2.setText(f'{count}')
-				t = create_tree()
-				x, y, z = random.uniform(terrain_pos.x, terrain_pos.x + terrain_size.x), random.uniform(terrain_pos.y, terrain_pos.y + terrain_size.y), Vec4()
-				peeker.fetch_pixel(z, int(x) - int(terrain_pos.x), int(y) - int(terrain_pos.y))
-				t.set_pos(x, y, z.x * terrain_size.z)
-				t.set_scale(random.uniform(.25, 1))
-				t = t.get_static()
-				t.reparent_to(base.render)
-				count += 1
+				for buffers in builder.poll_buffers():
+					scheduler.add(builder.iter_wrap(buffers), place_tree if pool is None else add_template)
+				if grid.dirty and not rebuilding:
+					# merge placed trees to cells batches
+					rebuilding = True
+					scheduler.add(grid.iter_rebuild(), rebuilt)
 				# base.screenshot()
 			else:
+				scheduler.stop()
+				scheduler.clear()
+				builder.shutdown()
+				if demo_running:
+					grid.rebuild() # the last placed trees
 				text.cleanup()
 				text2.cleanup()
 				return task.done # stop forest task
 			return task.cont
 
+		def get_terrain_pos() -> Vec3:
+			'returns next scattered point at terrain'
+			return Vec3(*next(terrain_points))
+
+		def place_tree(t: NodePath):
+			'place generated tree at terrain'
+			nonlocal count
+			grid.add(t, get_terrain_pos(), random.uniform(.25, 1))
+			count += 1
+
+		def add_template(t: NodePath):
+			pool.templates.append(t)
+			if pool.is_ready():
+				scheduler.add(iter_place_instances())
+
+		def iter_place_instances():
+			'place instances of the templates at terrain'
+			nonlocal count
+			while count < trees_count:
+				pool.place(grid, get_terrain_pos())
+				count += 1
+				if count % 100 == 0:
+					yield
+
+		def rebuilt(_):
+			nonlocal rebuilding
+			rebuilding = False
+
+		def show_progress(done: int, total: int):
+			text2.setText(f'{count} / {trees_count} trees, {done} / {total} jobs')
+
 		def setup_terrain():
-			heightfield_img = PNMImage(int(terrain_size.x), int(terrain_size.y), 1, 65535)
-			heightfield_img.fill(0, 0, 0)
-			heightfield_img.perlin_noise_fill(.075, .075, 32, 25)
-			highfield_tex = Texture()
-			highfield_tex.load(heightfield_img)
+			# generated once & cached: the next starts load the memory-mapped heightfield
+			heightfield = Heightfield.generate(int(terrain_size.x), int(terrain_size.y), TerrainNoise(seed=25), terrain_pos, terrain_size)
+			highfield_tex = heightfield.get_texture()
 			terrain_node = ShaderTerrainMesh()
 			terrain_node.heightfield = highfield_tex
 			terrain_node.target_triangle_width = 6.0
@@ -333,13 +922,11 @@ if __name__ == "__main__":
 			terrain_np.set_scale(terrain_size.x, terrain_size.y, terrain_size.z)
 			terrain_np.set_pos(terrain_pos.x, terrain_pos.y, 0)
 			terrain_np.set_shader(Shader.load(Shader.SL_GLSL, vertex='terrain/terrain.vert.glsl', fragment='terrain/terrain.frag.glsl'))
-			ts = TextureStage('map_texture')
-			terrain_texture = base.loader.load_texture('terrain/texture.grass.jpg')
-			terrain_texture.set_minfilter(Texture.FTLinearMipmapLinear)
-			terrain_texture.set_anisotropic_degree(16)
-			terrain_np.set_texture(ts, terrain_texture)
+			terrain_props = TextureProps('terrain/texture.grass.jpg', minfilter=Texture.FTLinearMipmapLinear, anisotropic_degree=16)
+			asset_watcher.watch_texture(terrain_props.load(terrain_np, TextureStage('map_texture'), texture_loader), terrain_props, texture_loader)
+			asset_watcher.watch_shader(base.render, 'terrain/terrain.vert.glsl', 'terrain/terrain.frag.glsl')
 			terrain_np.set_shader_input('texture_factor', Vec2(20, 20))
-			return terrain_np
+			return terrain_np, heightfield
 
 		base.cam.set_pos(-15, -250, 10)
 		base.cam.set_hpr(0, -5, 0)
@@ -349,23 +936,44 @@ if __name__ == "__main__":
 		ambient_light_np = base.render.attach_new_node(light)
 		base.render.set_light(ambient_light_np)
 		light.set_color(Vec4(0.85, 0.85, 0.9, 1))
-		count, text, text2 = 0, None, None
-		terrain_np = setup_terrain()
-		peeker = terrain_np.node().heightfield.peek()
+		count, rebuilding = 0, False
+		text = OnscreenText('FOREST GENERATION', scale=.1, fg=(.6, .5, .2, 1), bg=(0, 0, 0, .5), shadow=(0.5,0.5,0.5,1), frame=(0.05,0.05,0.05,1))
+		text2 = OnscreenText(f'0 / {trees_count}', pos=(0, -.15), scale=.05, fg=(.6, .5, .2, 1), bg=(0, 0, 0, .5), shadow=(0.5,0.5,0.5,1), frame=(0.05,0.05,0.05,1))
+		terrain_np, heightfield = setup_terrain()
+		# trees positions: blue noise spacing, steep slopes are rejected
+		points, _ = heightfield.scatter(8 if templates_count is None else 4, max_slope=.5)
+		np.random.default_rng().shuffle(points)
+		trees_count, terrain_points = min(trees_count, len(points)), iter(points.tolist())
+		builder, pool = ForestBuilder(lod_levels=FractalTree.LOD_LEVELS, instanced_leaves=True), None
+		if templates_count is None:
+			builder.submit(random.getrandbits(64) for _ in range(trees_count))
+		else:
+			pool = TreePool(builder, templates_count)
+			pool.submit()
+		grid = ForestGrid(base.render, terrain_pos, terrain_size, merge=pool is None)
+		scheduler = FrameScheduler(budget_ms=4, progress=show_progress) # increase budget to build the forest faster
+		scheduler.start()
 		base.taskMgr.add(forest_task, "forestTask") # start forest task
 
 	def tree():
+		'the tree is built by this process by frame budgeted steps'
+		global demo_running
+		demo_running = True
 		base.cam.set_pos(0, -500, 120)
-		t = DefaultTree()
-		t.reparent_to(base.render)
-		base.cam.look_at(t)
-		for _ in range(10):
-			t.grow()
-		look_camera_at_entire_object(t)
+		scheduler = FrameScheduler(budget_ms=4)
+
+		def built(tree_np: NodePath):
+			scheduler.stop()
+			if demo_running:
+				tree_np.reparent_to(base.render)
+				look_camera_at_entire_object(tree_np)
+
+		scheduler.add(DefaultTree(texture_loader=texture_loader).iter_build(10, .125), built)
+		scheduler.start()
 
 	def branch():
 		base.cam.set_pos(0, -50, 7)
-		t = DefaultTree()
+		t = DefaultTree(texture_loader=texture_loader)
 		t.reparent_to(base.render)
 		# t.setTexScale(t.bark_ts, 2, .25)
 		# t.setTexOffset(t.bark_ts, 2, 2)
@@ -389,7 +997,7 @@ if __name__ == "__main__":
 		count, last_timestamp = 0, 0
 		# base.cam.set_pos(50, -200, 10)
 		#  create tree
-		t = DefaultTree()
+		t = DefaultTree(texture_loader=texture_loader)
 		t.reparent_to(base.render)
 
 		def grow(task):
@@ -416,6 +1024,7 @@ if __name__ == "__main__":
 		))
 		demo_menu = RadioButtons(base, (
 			('Forest', forest),
+			('Forest of templates', lambda: forest(10)),
 			('Grow anomation', grow_animation),
 			('Tree', tree),
 			('Branch', branch))
@@ -0,0 +1,135 @@
+
+# python imports
+from typing import Optional, List, Tuple
+import os
+import hashlib
+
+# Panda3D imports
+from panda3d.core import NodePath, Filename, Loader, LoaderOptions, ShaderAttrib
+
+# other imports
+import numpy as np
+
+# Workbench imports
+from FractalBase import FractalBase
+from P3dTree import DefaultTree, InstancedLeaves
+
+
+class TreeCache:
+	'''
+	Content-addressed on-disk cache of baked trees: flattened get_static() node as .bam & skeleton arrays as .npz.
+	Entries are keyed by hash of generator class, its parameters, grow steps, seed & texture props;
+	least recently used entries are evicted when the cache size exceeds the cap.
+	'''
+
+	VERSION = 2 # change to invalidate entries baked by previous generator code
+	PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+
+	def __init__(self, path: str = PATH, max_size = 256 * 2 ** 20):
+		'''
+		path -:- cache directory
+		max_size -:- cache size cap, bytes
+		'''
+		self.path, self.max_size = path, max_size
+		os.makedirs(path, exist_ok=True)
+		self.hits = self.misses = 0
+
+	@classmethod
+	def get_key(cls, tree_class: type, seed: int, grow_steps: int, leaves_scale: float, **params) -> str:
+		'''returns cache key of the tree
+		params -:- tree class constructor parameters
+		'''
+		return hashlib.sha256(repr((
+			cls.VERSION, tree_class.__module__, tree_class.__qualname__, seed, grow_steps, leaves_scale,
+			sorted(params.items()), tree_class.get_assets_props()
+		)).encode()).hexdigest()
+
+	def get_paths(self, key: str) -> Tuple[str, str]:
+		'returns paths of the baked node & skeleton arrays files'
+		return os.path.join(self.path, f'{key}.bam'), os.path.join(self.path, f'{key}.npz')
+
+	def get(self, key: str) -> Optional[Tuple[NodePath, FractalBase.BranchStore]]:
+		'returns baked node & skeleton of the entry; None if the entry is absent'
+		bam_path, skeleton_path = self.get_paths(key)
+		if not (os.path.isfile(bam_path) and os.path.isfile(skeleton_path)):
+			self.misses += 1
+			return None
+		node = Loader.get_global_ptr().load_sync(Filename.from_os_specific(bam_path), LoaderOptions(LoaderOptions.LF_no_cache))
+		if node is None:
+			self.misses += 1
+			return None
+		tree_np = NodePath(node)
+		with np.load(skeleton_path) as arrays:
+			store = FractalBase.BranchStore.from_arrays(arrays)
+			for i, leaves_np in enumerate(InstancedLeaves.find_all(tree_np)):
+				# restore shader & leaves transforms buffer
+				InstancedLeaves(None, node_np=leaves_np).set_transforms(arrays[f'instanced_leaves_{i}'])
+		# mark the entry as recently used
+		os.utime(bam_path)
+		os.utime(skeleton_path)
+		self.hits += 1
+		return tree_np, store
+
+	def put(self, key: str, tree_np: NodePath, store: FractalBase.BranchStore) -> None:
+		'stores baked node & skeleton of the entry; evicts least recently used entries above the size cap'
+		bam_path, skeleton_path = self.get_paths(key)
+		arrays = store.get_arrays()
+		tree_np = tree_np.copy_to(NodePath())
+		for i, leaves_np in enumerate(InstancedLeaves.find_all(tree_np)):
+			# shaders can not be read from .bam file: the shader & leaves transforms are restored by get()
+			arrays[f'instanced_leaves_{i}'] = InstancedLeaves.get_node_matrices(leaves_np)
+			leaves_np.node().clear_attrib(ShaderAttrib)
+		# write to temporary files first: interrupted write should not leave broken entry
+		if not tree_np.write_bam_file(Filename.from_os_specific(f'{bam_path}.tmp.bam')):
+			raise IOError(f'can not write {bam_path}')
+		with open(f'{skeleton_path}.tmp', 'wb') as f:
+			np.savez(f, **arrays)
+		os.replace(f'{skeleton_path}.tmp', skeleton_path)
+		os.replace(f'{bam_path}.tmp.bam', bam_path)
+		self.evict()
+
+	def get_entries(self) -> List[Tuple[float, int, str]]:
+		'returns last use time, size & key of every entry'
+		ret = []
+		for name in os.listdir(self.path):
+			key, ext = os.path.splitext(name)
+			if ext != '.bam' or key.endswith('.tmp'):
+				continue
+			size, used = 0, 0.
+			for path in self.get_paths(key):
+				if os.path.isfile(path):
+					stat = os.stat(path)
+					size, used = size + stat.st_size, max(used, stat.st_mtime)
+			ret.append((used, size, key))
+		return ret
+
+	def evict(self, max_size: Optional[int] = None) -> None:
+		'removes least recently used entries until the cache size fits max_size; None - the cache size cap'
+		max_size = self.max_size if max_size is None else max_size
+		entries = sorted(self.get_entries())
+		size = sum(size for _, size, _ in entries)
+		for _, entry_size, key in entries:
+			if size <= max_size:
+				break
+			for path in self.get_paths(key):
+				if os.path.isfile(path):
+					os.remove(path)
+			size -= entry_size
+
+	def clear(self) -> None:
+		self.evict(0)
+
+	def get_tree(self, tree_class: type = DefaultTree, seed = 0, grow_steps = 10, leaves_scale = .125,
+			**params) -> Tuple[NodePath, FractalBase.BranchStore]:
+		'''returns flattened tree & its skeleton: loads baked tree or generates & bakes it
+		params -:- tree class constructor parameters
+		'''
+		key = self.get_key(tree_class, seed, grow_steps, leaves_scale, **params)
+		if (ret := self.get(key)) is not None:
+			return ret
+		t = tree_class(seed=seed, **{'deferred_meshing': True, **params}) # meshed once by get_static()
+		for i in range(grow_steps):
+			t.grow(i == grow_steps - 1, leaves_scale)
+		ret = t.get_static(), t.get_branch_store()
+		self.put(key, *ret)
+		return ret
@@ -0,0 +1,19 @@
+#version 330
+
+// Instanced leaves fragment shader: leaf texture lit by ambient light
+// and tinted by the leaf tint and the node color scale.
+
+in vec2 texcoord;
+in vec4 tint;
+out vec4 color;
+
+uniform sampler2D p3d_Texture0;
+uniform vec4 p3d_ColorScale;
+uniform struct {
+  vec4 ambient;
+} p3d_LightModel;
+
+void main() {
+  vec4 diffuse = texture(p3d_Texture0, texcoord);
+  color = vec4(diffuse.rgb * p3d_LightModel.ambient.rgb, diffuse.a) * tint * p3d_ColorScale;
+}
@@ -0,0 +1,26 @@
+#version 330
+
+// Instanced leaves vertex shader. Every instance takes its transform and
+// tint from the buffer texture: 4 texels are the rows of Panda3D matrix,
+// the 5th texel is the color scale of the leaf.
+
+in vec4 p3d_Vertex;
+in vec2 p3d_MultiTexCoord0;
+uniform mat4 p3d_ModelViewProjectionMatrix;
+uniform samplerBuffer leaf_transforms;
+
+out vec2 texcoord;
+out vec4 tint;
+
+void main() {
+  int row = gl_InstanceID * 5;
+  // matrix layout: see lib/InstanceBuffer.py
+  mat4 leaf_transform = mat4(
+    texelFetch(leaf_transforms, row),
+    texelFetch(leaf_transforms, row + 1),
+    texelFetch(leaf_transforms, row + 2),
+    texelFetch(leaf_transforms, row + 3));
+  gl_Position = p3d_ModelViewProjectionMatrix * (leaf_transform * p3d_Vertex);
+  texcoord = p3d_MultiTexCoord0;
+  tint = texelFetch(leaf_transforms, row + 4);
+}